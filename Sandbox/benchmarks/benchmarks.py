@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from Sandbox.utils.dct import dct2, block_dct2
+from Sandbox.utils.image_utils import block_view, split_image, unsplit_image
+from Sandbox.jpeg.jpeg import JpegCompressor
+
+"""
+Performance benchmarks
+
+Each workload is timed on synthetic images from 64x64 up to 8K and reported
+as megapixels per second (best of several runs, with the median run time
+alongside) and the peak memory traced in the calling process (process pool
+workers are not included).  The parallel mode reuses one warmed up worker
+pool and only runs on images large enough to use it.  Results are written
+as JSON, with the machine they ran on, and can be compared against a
+stored baseline.  Workloads that look slower are timed again before they
+are reported as regressions, and parallel workloads are only compared on
+a machine with the same number of CPUs.
+
+Run with:  make benchmark, or python -m Sandbox.benchmarks.benchmarks --help
+"""
+
+# (height, width) of each benchmark image size
+SIZES = {'64x64': (64, 64),
+         '256x256': (256, 256),
+         '1024x1024': (1024, 1024),
+         '1080p': (1080, 1920),
+         '4K': (2160, 3840),
+         '8K': (4320, 7680)}
+
+# Fractional slowdown against the baseline that is reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Each workload is repeated until it has run for at least MIN_TIME seconds,
+# at least MIN_REPEATS times
+MIN_TIME = 0.2
+MIN_REPEATS = 5
+
+# Times a suspected regression is benchmarked again before it is reported
+CONFIRM_RUNS = 3
+
+# machine_info keys that must match the baseline for timings to compare
+MACHINE_KEYS = ('machine', 'processor', 'cpu_count')
+
+
+def synthetic_image(height, width, seed=0):
+    """Return a deterministic 8-bit RGB image with smooth gradients, edges
+    and noise, loosely resembling photographic content"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width] / 64.0
+
+    image = np.empty((height, width, 3))
+    for chan in range(3):
+        image[..., chan] = (128 + 60 * np.sin(x * (chan + 1) + y) +
+                            40 * np.sign(np.sin(y * 0.7 - x * 0.3 + chan)))
+    image += rng.normal(scale=8, size=image.shape)
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _warm_up(compressor, image):
+    """Compress image once, starting the worker pool, and return it"""
+    compressor.compress(image)
+    return image
+
+
+def _workloads(image, parallel):
+    """Return (name, mode, setup, function) for each benchmarked workload.
+    setup runs once, untimed, and its result is passed to function.
+
+    The parallel mode uses the compressor parallel, and is left out for
+    images it would encode serially."""
+    plane = np.ascontiguousarray(image[..., 0], dtype=np.float64)
+    height, width = plane.shape
+    shape = (-(-height // 8), -(-width // 8))
+    serial = JpegCompressor()
+
+    workloads = [
+        ('dct2', 'serial', lambda: plane, dct2),
+        ('block_dct2', 'serial', lambda: block_view(plane), block_dct2),
+        ('split_image', 'serial', lambda: plane, split_image),
+        ('unsplit_image', 'serial', lambda: split_image(plane),
+         lambda blocks: unsplit_image(blocks, shape)),
+        ('compress', 'serial', lambda: image, serial.compress),
+        ('decompress', 'serial', lambda: serial.compress(image),
+         serial.decompress),
+        # Last, as forked workers keep the memory they share with this
+        # process from being freed
+        ('compress', 'parallel', lambda: _warm_up(parallel, image),
+         parallel.compress),
+    ]
+    if height * width < parallel.PARALLEL_MIN_PIXELS:
+        workloads = [workload for workload in workloads
+                     if workload[1] != 'parallel']
+    return workloads
+
+
+def _time(function, arg):
+    """Return the run times of repeated calls of function(arg)"""
+    times = []
+    start = time.perf_counter()
+    while len(times) < MIN_REPEATS or time.perf_counter() - start < MIN_TIME:
+        begin = time.perf_counter()
+        function(arg)
+        times.append(time.perf_counter() - begin)
+
+    return times
+
+
+def _peak_memory(function, arg):
+    """Return the peak memory, in bytes, traced while running function(arg)"""
+    tracemalloc.start()
+    try:
+        function(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes=None, workloads=None, workers=None, log=None):
+    """Run the benchmarks and return a list of result dicts
+
+    sizes and workloads restrict the run to the given names.  workers is the
+    number of workers of the parallel mode, at least 2 and by default the
+    number of CPUs."""
+    if sizes is None:
+        sizes = list(SIZES)
+    if workers is None:
+        workers = max(os.cpu_count() or 1, 2)
+
+    results = []
+    for size in sizes:
+        height, width = SIZES[size]
+        image = synthetic_image(height, width)
+        megapixels = height * width / 1e6
+
+        with JpegCompressor(workers=workers) as parallel:
+            for name, mode, setup, function in _workloads(image, parallel):
+                if workloads is not None and name not in workloads:
+                    continue
+
+                arg = setup()
+                times = _time(function, arg)
+                seconds = min(times)
+                result = {'workload': name, 'mode': mode, 'size': size,
+                          'megapixels': megapixels, 'seconds': seconds,
+                          'median_seconds': float(np.median(times)),
+                          'repeats': len(times),
+                          'megapixels_per_second': megapixels / seconds,
+                          'peak_memory_mb': _peak_memory(function, arg) / 1e6}
+                results.append(result)
+                del arg
+
+                if log is not None:
+                    log.write('{workload:>14} {mode:>8} {size:>9}  '
+                              '{megapixels_per_second:10.2f} MP/s  '
+                              '{peak_memory_mb:9.1f} MB\n'.format(**result))
+
+    return results
+
+
+def machine_info():
+    """Return a description of the machine the benchmarks ran on"""
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+def machine_differences(machine, baseline_machine):
+    """Return the MACHINE_KEYS of machine_info that differ from those of the
+    baseline's machine"""
+    return [key for key in MACHINE_KEYS
+            if machine.get(key) != baseline_machine.get(key)]
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE, parallel=True):
+    """Compare results against baseline results
+
+    Returns a list of (result, baseline_result, ratio) for every workload
+    whose throughput fell more than tolerance (a fraction) below the
+    baseline.  Workloads missing from the baseline, and parallel workloads
+    unless parallel is true, are skipped."""
+    def key(result):
+        return result['workload'], result['mode'], result['size']
+
+    reference = {key(result): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        base = reference.get(key(result))
+        if base is None or (result['mode'] == 'parallel' and not parallel):
+            continue
+        ratio = (result['megapixels_per_second'] /
+                 base['megapixels_per_second'])
+        if ratio < 1 - tolerance:
+            regressions.append((result, base, ratio))
+
+    return regressions
+
+
+def confirm(regressions, tolerance=DEFAULT_TOLERANCE, workers=None,
+            runs=CONFIRM_RUNS):
+    """Benchmark each regression again runs times
+
+    Returns the regressions whose best throughput over every run is still
+    more than tolerance below the baseline, as returned by compare."""
+    confirmed = []
+    for result, base, ratio in regressions:
+        best = result
+        for _ in range(runs):
+            for rerun in run([result['size']], [result['workload']],
+                             workers):
+                if (rerun['mode'] == result['mode'] and
+                        rerun['megapixels_per_second'] >
+                        best['megapixels_per_second']):
+                    best = rerun
+
+        ratio = (best['megapixels_per_second'] /
+                 base['megapixels_per_second'])
+        if ratio < 1 - tolerance:
+            confirmed.append((best, base, ratio))
+
+    return confirmed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the performance benchmarks')
+    parser.add_argument('--sizes', help='comma separated image sizes, from '
+                        + ', '.join(SIZES))
+    parser.add_argument('--workloads',
+                        help='comma separated workloads to run')
+    parser.add_argument('--workers', type=int,
+                        help='workers of the parallel mode')
+    parser.add_argument('--output', help='write JSON results to this file '
+                        '(default stdout)')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed fractional slowdown against the '
+                        'baseline (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes.split(',') if args.sizes else None
+    workloads = args.workloads.split(',') if args.workloads else None
+    for size in sizes or []:
+        if size not in SIZES:
+            parser.error("unknown size {!r}".format(size))
+
+    results = run(sizes, workloads, args.workers, log=sys.stderr)
+    report = {'machine': machine_info(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        differences = machine_differences(report['machine'],
+                                          baseline.get('machine', {}))
+        for key in differences:
+            sys.stderr.write(
+                'WARNING {} is {!r}, baseline {!r}: timings may not be '
+                'comparable\n'.format(key, report['machine'].get(key),
+                                      baseline.get('machine', {}).get(key)))
+        parallel = 'cpu_count' not in differences
+        if not parallel:
+            sys.stderr.write('Parallel workloads are not compared\n')
+
+        regressions = compare(results, baseline['results'], args.tolerance,
+                              parallel)
+        regressions = confirm(regressions, args.tolerance, args.workers)
+        for result, base, ratio in regressions:
+            sys.stderr.write(
+                'REGRESSION {workload} {mode} {size}: {mp:.2f} MP/s, '
+                'baseline {base:.2f} MP/s ({ratio:.0%})\n'.format(
+                    mp=result['megapixels_per_second'],
+                    base=base['megapixels_per_second'], ratio=ratio,
+                    **result))
+        if regressions:
+            return 1
+        sys.stderr.write('No regressions against {}\n'.format(args.baseline))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
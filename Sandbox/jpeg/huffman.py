@@ -0,0 +1,808 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import re
+
+import numpy as np
+
+"""
+Baseline JPEG entropy coding
+
+Blocks are coded in zigzag order.  The DC coefficient is coded as the
+difference from the previous block of the same component, and the AC
+coefficients as (run of zeros, size) symbols, with the coefficient value
+appended as extra bits.  Symbols are Huffman coded with the tables of JPEG
+Annex K, and the coded bits are packed MSB first with a 0x00 byte stuffed
+after every 0xFF byte.
+
+Decoding looks up LOOKUP_BITS bits of the scan at a time in tables that
+give the code length and symbol starting with those bits, and for short
+codes the value of the extra bits too, so most coefficients take one
+lookup.  Longer codes fall back to the search of JPEG Annex F.2.2.3.
+
+Instead of the Annex K tables, optimal tables for an image can be built
+from the symbol frequencies of its scan (JPEG Annex K.2), which typically
+shortens the scan by several percent.
+
+A scan may be divided into restart intervals of a fixed number of blocks,
+separated by RSTn markers.  Each interval starts on a byte boundary with
+the DC predictions reset, so intervals can be decoded independently.
+"""
+
+
+def _zigzag_order(n=8):
+    """Return the raster index of each coefficient of an nxn block in zigzag
+    order"""
+    def diagonal_position(index):
+        row, col = divmod(index, n)
+        diagonal = row + col
+        return diagonal, col if diagonal % 2 == 0 else row
+
+    return np.array(sorted(range(n * n), key=diagonal_position))
+
+
+# Raster index of the coefficient at each zigzag position, and its inverse
+ZIGZAG = _zigzag_order()
+UNZIGZAG = np.argsort(ZIGZAG)
+
+# Largest size category allowed by baseline JPEG for DC differences and for
+# AC coefficients
+MAX_DC_SIZE = 11
+MAX_AC_SIZE = 10
+
+# Special AC symbols: end of block and a run of 16 zeros
+EOB = 0x00
+ZRL = 0xF0
+
+_POWERS_OF_2 = 1 << np.arange(17)
+
+# Bits of scan data resolved by one decoding table lookup
+LOOKUP_BITS = 9
+
+# First of the eight cycling restart markers, RST0 to RST7
+_RST0 = 0xD0
+
+# Any restart marker in entropy coded data, where 0xFF is otherwise always
+# followed by a stuffed 0x00
+_RESTART_MARKER = re.compile(b'\xff[\xd0-\xd7]')
+
+# 0xFF bytes, which are followed by a stuffed 0x00 or start a marker.  A
+# regex, unlike bytes.find, also searches memoryviews in place.
+_FF = re.compile(b'\xff')
+
+
+class HuffmanTable(object):
+    """Canonical Huffman table defined by the JPEG BITS and HUFFVAL lists
+
+    bits[n] is the number of codes of length n + 1 and values lists the
+    symbols in order of increasing code length."""
+    def __init__(self, bits, values):
+        self.bits = np.asarray(bits, dtype=int)
+        self.values = np.asarray(values, dtype=int)
+
+        if self.bits.shape != (16,) or self.bits.sum() != self.values.size:
+            raise ValueError("BITS must have 16 entries that sum to the "
+                             "number of values")
+
+        # Generate the canonical code of each symbol (JPEG Annex C)
+        lengths = np.repeat(np.arange(1, 17), self.bits)
+        codes = np.zeros(self.values.size, dtype=np.int64)
+        code = 0
+        for n in range(1, self.values.size):
+            code = (code + 1) << (lengths[n] - lengths[n - 1])
+            codes[n] = code
+
+        # Symbol indexed code lookup tables.  A length of 0 means no code.
+        self.codes = np.zeros(256, dtype=np.int64)
+        self.code_lengths = np.zeros(256, dtype=np.int64)
+        self.codes[self.values] = codes
+        self.code_lengths[self.values] = lengths
+
+        # Decoding tables (JPEG Annex F.2.2.3)
+        self._maxcode = np.full(17, -1, dtype=np.int64)
+        self._valptr = np.zeros(17, dtype=np.int64)
+        self._mincode = np.zeros(17, dtype=np.int64)
+        first = 0
+        for length in range(1, 17):
+            count = self.bits[length - 1]
+            if count:
+                self._valptr[length] = first
+                self._mincode[length] = codes[first]
+                self._maxcode[length] = codes[first + count - 1]
+                first += count
+        self._maxcode = self._maxcode.tolist()
+        self._mincode = self._mincode.tolist()
+        self._valptr = self._valptr.tolist()
+        self._value_list = self.values.tolist()
+        self._lookup = self._lookup_table(codes.tolist(), lengths.tolist())
+
+    def _lookup_table(self, codes, lengths):
+        """Return the decoding table indexed by the next LOOKUP_BITS bits of
+        a scan
+
+        Entries are (length, run, size, value) tuples of the symbol whose
+        code starts the bits, where length is the number of bits consumed.
+        If the code and its size extra bits fit in LOOKUP_BITS, value is the
+        decoded extra bits, otherwise it is None and the extra bits follow.
+        Entries of longer codes are None."""
+        lookup = [None] * (1 << LOOKUP_BITS)
+        for code, length, symbol in zip(codes, lengths, self._value_list):
+            if length > LOOKUP_BITS:
+                continue
+
+            run, size = symbol >> 4, symbol & 15
+            if length + size > LOOKUP_BITS:
+                shift = LOOKUP_BITS - length
+                lookup[code << shift:(code + 1) << shift] = (
+                    [(length, run, size, None)] * (1 << shift))
+                continue
+
+            shift = LOOKUP_BITS - length - size
+            for bits in range(1 << size):
+                value = bits
+                if size and bits < (1 << (size - 1)):
+                    value -= (1 << size) - 1
+                start = ((code << size) | bits) << shift
+                lookup[start:start + (1 << shift)] = (
+                    [(length + size, run, size, value)] * (1 << shift))
+
+        return lookup
+
+    def _decode_long(self, code):
+        """Decode a code longer than LOOKUP_BITS from the next 16 bits of a
+        scan, returning a lookup table entry"""
+        for length in range(LOOKUP_BITS + 1, 17):
+            prefix = code >> (16 - length)
+            if prefix <= self._maxcode[length]:
+                symbol = self._value_list[self._valptr[length] + prefix -
+                                          self._mincode[length]]
+                return length, symbol >> 4, symbol & 15, None
+
+        raise ValueError("Invalid Huffman code in scan data")
+
+
+def optimal_table(frequencies):
+    """Return the optimal HuffmanTable, with codes of at most 16 bits, for
+    the given counts of each of the 256 symbols (JPEG Annex K.2)
+
+    Symbols with a count of 0 get no code.  As the standard requires, no
+    code is all 1 bits."""
+    # A reserved symbol 256 with the lowest count takes the all 1 bits code
+    freq = [int(f) for f in frequencies] + [1]
+    code_size = [0] * 257
+    others = [-1] * 257
+
+    # Merge the two least frequent trees until one is left, lengthening
+    # the codes of every symbol in both
+    heap = [(f, symbol) for symbol, f in enumerate(freq) if f]
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        freq1, c1 = heapq.heappop(heap)
+        freq2, c2 = heapq.heappop(heap)
+        heapq.heappush(heap, (freq1 + freq2, c1))
+
+        for c in (c1, c2):
+            code_size[c] += 1
+            while others[c] >= 0:
+                c = others[c]
+                code_size[c] += 1
+        c = c1
+        while others[c] >= 0:
+            c = others[c]
+        others[c] = c2
+
+    bits = [0] * (max(max(code_size), 16) + 1)
+    for size in code_size:
+        if size:
+            bits[size] += 1
+
+    # Limit code lengths to 16 bits by moving pairs of symbols up the tree
+    for size in range(len(bits) - 1, 16, -1):
+        while bits[size]:
+            j = size - 2
+            while not bits[j]:
+                j -= 1
+            bits[size] -= 2
+            bits[size - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+
+    # Drop the reserved symbol, which has the longest code
+    size = 16
+    while not bits[size]:
+        size -= 1
+    bits[size] -= 1
+
+    values = sorted((code_size[symbol], symbol) for symbol in range(256)
+                    if code_size[symbol])
+    return HuffmanTable(bits[1:17], [symbol for _, symbol in values])
+
+
+# Standard Huffman tables from JPEG Annex K.3
+DC_LUMINANCE = HuffmanTable(
+    [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], range(12))
+
+DC_CHROMINANCE = HuffmanTable(
+    [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], range(12))
+
+AC_LUMINANCE = HuffmanTable(
+    [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d],
+    [0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12,
+     0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+     0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08,
+     0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+     0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16,
+     0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+     0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39,
+     0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+     0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59,
+     0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+     0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79,
+     0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+     0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98,
+     0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+     0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6,
+     0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+     0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4,
+     0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+     0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea,
+     0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+     0xf9, 0xfa])
+
+AC_CHROMINANCE = HuffmanTable(
+    [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77],
+    [0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21,
+     0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+     0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91,
+     0xa1, 0xb1, 0xc1, 0x09, 0x23, 0x33, 0x52, 0xf0,
+     0x15, 0x62, 0x72, 0xd1, 0x0a, 0x16, 0x24, 0x34,
+     0xe1, 0x25, 0xf1, 0x17, 0x18, 0x19, 0x1a, 0x26,
+     0x27, 0x28, 0x29, 0x2a, 0x35, 0x36, 0x37, 0x38,
+     0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+     0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58,
+     0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+     0x69, 0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78,
+     0x79, 0x7a, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+     0x88, 0x89, 0x8a, 0x92, 0x93, 0x94, 0x95, 0x96,
+     0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5,
+     0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4,
+     0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3,
+     0xc4, 0xc5, 0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2,
+     0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda,
+     0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9,
+     0xea, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+     0xf9, 0xfa])
+
+
+class BitWriter(object):
+    """Packs variable length codes into an entropy coded JPEG byte stream
+
+    Codes are packed MSB first and every 0xFF byte is followed by a stuffed
+    0x00 byte.  Bits that do not yet fill a whole byte are kept until the
+    next write or flush."""
+    # Number of codes packed per vectorized pass, to bound temporary memory
+    CHUNK_SIZE = 1 << 15
+
+    def __init__(self):
+        self._chunks = []
+        self._value = 0
+        self._n_bits = 0
+
+    def write(self, values, lengths):
+        """Append the low lengths[n] bits of each values[n]"""
+        values = np.asarray(values, dtype=np.int64).ravel()
+        lengths = np.asarray(lengths, dtype=np.int64).ravel()
+
+        for start in range(0, values.size, self.CHUNK_SIZE):
+            stop = start + self.CHUNK_SIZE
+            self._write_chunk(values[start:stop], lengths[start:stop])
+
+    def flush(self):
+        """Pad the last partial byte with 1 bits, as required by JPEG"""
+        if self._n_bits:
+            pad = 8 - self._n_bits
+            self._write_chunk(np.array([(1 << pad) - 1]), np.array([pad]))
+
+    def restart(self, index):
+        """Flush and write restart marker RSTn for n = index % 8"""
+        self.flush()
+        self._chunks.append(bytes([0xFF, _RST0 + index % 8]))
+
+    def getvalue(self):
+        """Return all complete bytes written so far"""
+        return b''.join(self._chunks)
+
+    def drain(self):
+        """Return the complete bytes written since the last drain and release
+        them, so a stream can be written out as it is coded"""
+        data = self.getvalue()
+        self._chunks = []
+        return data
+
+    def _write_chunk(self, values, lengths):
+        # Start with the bits left over from the previous chunk
+        values = np.concatenate(([self._value], values))
+        lengths = np.concatenate(([self._n_bits], lengths))
+
+        # Expand every code into one uint8 per bit, MSB first
+        n_bits = lengths.sum()
+        owner = np.repeat(np.arange(values.size), lengths)
+        shift = np.cumsum(lengths)[owner] - 1 - np.arange(n_bits)
+        bits = ((values[owner] >> shift) & 1).astype(np.uint8)
+
+        n_whole = n_bits - n_bits % 8
+        data = np.packbits(bits[:n_whole])
+
+        stuff = np.flatnonzero(data == 0xFF) + 1
+        if stuff.size:
+            data = np.insert(data, stuff, 0)
+        self._chunks.append(data.tobytes())
+
+        self._value = 0
+        for bit in bits[n_whole:].tolist():
+            self._value = (self._value << 1) | bit
+        self._n_bits = n_bits - n_whole
+
+
+class BitReader(object):
+    """Reads the bits of an entropy coded JPEG byte stream, removing the
+    0x00 byte stuffed after every 0xFF byte as it goes
+
+    Bits are read into an integer accumulator held by the caller, so that
+    decoding loops can shift and mask it without method calls:
+    acc, n_bits = reader.fill(acc, n_bits) appends bytes to the n_bits bits
+    left in acc.  The end of the data, or a marker, is padded with 0 bits,
+    counted in padding.
+
+    data may be any bytes-like object, such as a memoryview slice of a
+    file's contents, and is read in place."""
+    # Bits held in the accumulator after a fill
+    MIN_BITS = 32
+
+    def __init__(self, data):
+        self._data = memoryview(data).cast('B')
+        self._pos = 0
+        self._next_ff = self._find_ff(0)
+        self.padding = 0
+
+    def _find_ff(self, start):
+        match = _FF.search(self._data, start)
+        return len(self._data) if match is None else match.start()
+
+    def fill(self, acc, n_bits):
+        """Return acc and n_bits with at least MIN_BITS bits"""
+        acc &= (1 << n_bits) - 1
+        pos = self._pos
+
+        # Six bytes at once when none of them is 0xFF
+        if pos + 6 <= self._next_ff:
+            self._pos = pos + 6
+            return ((acc << 48) | int.from_bytes(self._data[pos:pos + 6],
+                                                 'big'), n_bits + 48)
+
+        data = self._data
+        while n_bits < self.MIN_BITS:
+            if pos < self._next_ff:
+                acc = (acc << 8) | data[pos]
+                pos += 1
+            elif pos + 1 < len(data) and data[pos + 1] == 0:
+                acc = (acc << 8) | 0xFF
+                pos += 2
+                self._next_ff = self._find_ff(pos)
+            else:
+                acc <<= 8
+                self.padding += 8
+            n_bits += 8
+
+        self._pos = pos
+        return acc, n_bits
+
+
+def zigzag(blocks):
+    """Return the zigzag (..., 64) coefficients of (..., 8, 8) blocks"""
+    blocks = np.asarray(blocks)
+    return blocks.reshape(blocks.shape[:-2] + (64,))[..., ZIGZAG]
+
+
+def unzigzag(coeffs):
+    """Return the (..., 8, 8) blocks of zigzag (..., 64) coefficients"""
+    coeffs = np.asarray(coeffs)
+    return coeffs[..., UNZIGZAG].reshape(coeffs.shape[:-1] + (8, 8))
+
+
+def scan_components(grids, sampling):
+    """Return the component index of each block of an interleaved scan,
+    given the (rows, cols) block grid and (h, v) sampling factors of each
+    component"""
+    rows, cols = grids[0]
+    h, v = sampling[0]
+    n_mcus = (rows // v) * (cols // h)
+    mcu = [comp for comp, (h, v) in enumerate(sampling) for _ in range(h * v)]
+
+    return np.tile(mcu, n_mcus)
+
+
+def interleave(coefficients, sampling=None):
+    """Arrange the blocks of each component in interleaved scan order
+
+    coefficients is a list of (rows, cols, 8, 8) block arrays, one for each
+    component, and sampling the (h, v) sampling factors of each component
+    (all (1, 1) by default).  Each minimum coded unit (MCU) holds a v x h
+    group of blocks from every component.  Returns the (n_blocks, 64) zigzag
+    ordered blocks and the component index of each block."""
+    if sampling is None:
+        sampling = [(1, 1)] * len(coefficients)
+
+    mcus = []
+    for coeffs, (h, v) in zip(coefficients, sampling):
+        rows, cols = coeffs.shape[:2]
+        zz = zigzag(coeffs).reshape((rows // v, v, cols // h, h, 64))
+        mcus.append(zz.swapaxes(1, 2).reshape((-1, v * h, 64)))
+
+    grids = [coeffs.shape[:2] for coeffs in coefficients]
+    zz = np.concatenate(mcus, axis=1).reshape((-1, 64))
+
+    return zz, scan_components(grids, sampling)
+
+
+def deinterleave(zz, grids, sampling=None):
+    """Invert interleave, given the (rows, cols) block grid and the sampling
+    factors of each component"""
+    if sampling is None:
+        sampling = [(1, 1)] * len(grids)
+
+    blocks_per_mcu = sum(h * v for h, v in sampling)
+    zz = zz.reshape((-1, blocks_per_mcu, 64))
+
+    coefficients = []
+    start = 0
+    for (rows, cols), (h, v) in zip(grids, sampling):
+        comp = zz[:, start:start + v * h].reshape((rows // v, cols // h,
+                                                   v, h, 64))
+        comp = comp.swapaxes(1, 2).reshape((rows, cols, 64))
+        coefficients.append(unzigzag(comp))
+        start += v * h
+
+    return coefficients
+
+
+def _magnitude_bits(values):
+    """Return the JPEG size category and appended bits of each value"""
+    sizes = np.searchsorted(_POWERS_OF_2, np.abs(values), side='right')
+    bits = np.where(values < 0, values + (1 << sizes) - 1, values)
+
+    return sizes, bits
+
+
+def _dc_differences(zz, components, predictors):
+    """Return the difference of each DC coefficient from the previous block
+    of the same component, updating predictors (see scan_symbols)"""
+    dc = zz[:, 0]
+    dc_diff = np.empty_like(dc)
+    for comp in np.unique(components):
+        index = np.flatnonzero(components == comp)
+        dc_diff[index] = np.diff(dc[index], prepend=predictors.get(comp, 0))
+        predictors[comp] = dc[index[-1]]
+
+    return dc_diff
+
+
+def _ac_runs(zz):
+    """Return the block, zigzag position and value of every nonzero AC
+    coefficient, and the run of zeros before it"""
+    ac_block, ac_pos = np.nonzero(zz[:, 1:])
+    ac_pos += 1
+    ac_values = zz[ac_block, ac_pos]
+
+    prev_pos = np.zeros_like(ac_pos)
+    prev_pos[1:] = ac_pos[:-1]
+    prev_pos[np.flatnonzero(np.diff(ac_block, prepend=-1))] = 0
+    runs = ac_pos - prev_pos - 1
+
+    return ac_block, ac_pos, ac_values, runs
+
+
+def scan_symbols(zz, components, predictors=None):
+    """Return the Huffman symbols that code a sequence of blocks
+
+    zz is an (n_blocks, 64) array of zigzag ordered blocks in scan order and
+    components is the component index of each block.  Returns, in coding
+    order, the block index, an AC flag, the symbol, and the value and bit
+    length of the extra bits appended to each symbol.
+
+    predictors maps each component to the DC value of its previous block
+    (0 at the start of a scan) and is updated in place, so a scan can be
+    coded in several pieces."""
+    if predictors is None:
+        predictors = {}
+
+    zz = np.asarray(zz, dtype=np.int64)
+    components = np.asarray(components)
+    n_blocks = zz.shape[0]
+
+    dc_sizes, dc_bits = _magnitude_bits(_dc_differences(zz, components,
+                                                        predictors))
+    if np.any(dc_sizes > MAX_DC_SIZE):
+        raise ValueError("DC difference out of range for baseline JPEG")
+
+    ac_block, ac_pos, ac_values, runs = _ac_runs(zz)
+    ac_sizes, ac_bits = _magnitude_bits(ac_values)
+    if np.any(ac_sizes > MAX_AC_SIZE):
+        raise ValueError("AC coefficient out of range for baseline JPEG")
+
+    # Runs longer than 15 zeros need ZRL symbols before the coefficient
+    zrl_owner = np.repeat(np.arange(ac_pos.size), runs // 16)
+
+    # Blocks that end in zeros are terminated with EOB
+    eob_block = np.flatnonzero(zz[:, 63] == 0)
+
+    # Sort all symbols by block, then zigzag position
+    n_zrl = zrl_owner.size
+    n_eob = eob_block.size
+    keys = np.concatenate((np.arange(n_blocks) * 129,
+                           ac_block[zrl_owner] * 129 + ac_pos[zrl_owner] * 2,
+                           ac_block * 129 + ac_pos * 2 + 1,
+                           eob_block * 129 + 128))
+    order = np.argsort(keys, kind='stable')
+
+    block = np.concatenate((np.arange(n_blocks), ac_block[zrl_owner],
+                            ac_block, eob_block))[order]
+    is_ac = np.concatenate((np.zeros(n_blocks, dtype=bool),
+                            np.ones(n_zrl + ac_pos.size + n_eob,
+                                    dtype=bool)))[order]
+    symbol = np.concatenate((dc_sizes, np.full(n_zrl, ZRL),
+                             ((runs % 16) << 4) | ac_sizes,
+                             np.full(n_eob, EOB)))[order]
+    extra = np.concatenate((dc_bits, np.zeros(n_zrl, dtype=np.int64),
+                            ac_bits, np.zeros(n_eob, dtype=np.int64)))[order]
+    extra_len = np.concatenate((dc_sizes, np.zeros(n_zrl, dtype=np.int64),
+                                ac_sizes,
+                                np.zeros(n_eob, dtype=np.int64)))[order]
+
+    return block, is_ac, symbol, extra, extra_len
+
+
+def _table_lookup(tables, index, symbol):
+    """Return the code and code length of each symbol, where index selects
+    the table used for each symbol"""
+    codes = np.stack([table.codes for table in tables])[index, symbol]
+    lengths = np.stack([table.code_lengths for table in tables])[index, symbol]
+
+    if np.any(lengths == 0):
+        raise ValueError("Symbol missing from Huffman table")
+
+    return codes, lengths
+
+
+def encode_blocks(zz, components, dc_tables, ac_tables, writer=None,
+                  predictors=None, restart_interval=0, position=0):
+    """Huffman code a sequence of zigzag ordered blocks
+
+    dc_tables and ac_tables give the HuffmanTable of each component.  The
+    codes are written to writer, a BitWriter, which is returned.  predictors
+    carries the DC predictions between pieces of a scan, see scan_symbols.
+
+    restart_interval > 0 writes a restart marker before every
+    restart_interval-th block of the scan, counting from position, the
+    number of blocks of the scan coded before zz."""
+    if writer is None:
+        writer = BitWriter()
+    if predictors is None:
+        predictors = {}
+
+    if restart_interval:
+        components = np.asarray(components)
+        start = 0
+        while start < len(zz):
+            # Code the blocks up to the next interval boundary
+            interval, offset = divmod(position + start, restart_interval)
+            if interval and not offset:
+                writer.restart(interval - 1)
+                predictors.clear()
+            stop = start + restart_interval - offset
+            encode_blocks(zz[start:stop], components[start:stop], dc_tables,
+                          ac_tables, writer, predictors)
+            start = stop
+        return writer
+
+    block, is_ac, symbol, extra, extra_len = scan_symbols(zz, components,
+                                                          predictors)
+
+    # Tables are indexed as [dc_0, ac_0, dc_1, ac_1, ...]
+    tables = [table for pair in zip(dc_tables, ac_tables) for table in pair]
+    table_index = np.asarray(components)[block] * 2 + is_ac
+    codes, lengths = _table_lookup(tables, table_index, symbol)
+
+    writer.write((codes << extra_len) | extra, lengths + extra_len)
+
+    return writer
+
+
+def scan_bits(zz, components, dc_tables, ac_tables):
+    """Return the number of bits encode_blocks codes a sequence of blocks
+    into, before byte stuffing and padding
+
+    Only the code lengths are summed, so this is much cheaper than coding
+    the blocks.  Coefficients out of range for baseline JPEG are not
+    checked."""
+    zz = np.asarray(zz)
+    components = np.asarray(components)
+    dc_lengths = np.stack([table.code_lengths for table in dc_tables])
+    ac_lengths = np.stack([table.code_lengths for table in ac_tables])
+
+    dc_sizes = _magnitude_bits(_dc_differences(zz.astype(np.int64),
+                                               components, {}))[0]
+    ac_block, ac_pos, ac_values, runs = _ac_runs(zz)
+    ac_sizes = _magnitude_bits(ac_values)[0]
+    ac_components = components[ac_block]
+    eob_components = components[zz[:, 63] == 0]
+
+    lengths = [dc_lengths[components, dc_sizes],
+               ac_lengths[ac_components, ((runs % 16) << 4) | ac_sizes],
+               ac_lengths[eob_components, EOB]]
+    if any(np.any(length == 0) for length in lengths):
+        raise ValueError("Symbol missing from Huffman table")
+
+    n_zrl = np.bincount(ac_components, runs // 16,
+                        minlength=len(ac_tables)).astype(np.int64)
+    zrl_lengths = ac_lengths[:, ZRL]
+    if np.any(zrl_lengths[n_zrl > 0] == 0):
+        raise ValueError("Symbol missing from Huffman table")
+
+    return int(sum(length.sum() for length in lengths) + dc_sizes.sum() +
+               ac_sizes.sum() + (n_zrl * zrl_lengths).sum())
+
+
+def symbol_frequencies(zz, components, n_components, restart_interval=0):
+    """Return (n_components, 256) arrays counting the DC and the AC symbols
+    of each component that encode_blocks codes a sequence of blocks with
+
+    restart_interval is the number of blocks between restart markers, where
+    the DC predictions are reset, or 0 for none."""
+    zz = np.asarray(zz, dtype=np.int64)
+    components = np.asarray(components)
+
+    dc_diff = _dc_differences(zz, components, {})
+    if restart_interval:
+        # The first block of each component in an interval is coded as is
+        interval = np.arange(len(zz)) // restart_interval
+        for comp in np.unique(components):
+            index = np.flatnonzero(components == comp)
+            first = index[np.diff(interval[index], prepend=-1) != 0]
+            dc_diff[first] = zz[first, 0]
+    dc_sizes = _magnitude_bits(dc_diff)[0]
+
+    ac_block, ac_pos, ac_values, runs = _ac_runs(zz)
+    ac_sizes = _magnitude_bits(ac_values)[0]
+    ac_components = components[ac_block]
+    eob_components = components[zz[:, 63] == 0]
+
+    size = n_components * 256
+    dc_counts = np.bincount(components * 256 + dc_sizes, minlength=size)
+    ac_counts = np.bincount(
+        ac_components * 256 + (((runs % 16) << 4) | ac_sizes),
+        minlength=size)
+    ac_counts += np.bincount(eob_components * 256 + EOB, minlength=size)
+    ac_counts += np.bincount(ac_components * 256 + ZRL, runs // 16,
+                             minlength=size).astype(np.int64)
+
+    return (dc_counts.reshape((n_components, 256)),
+            ac_counts.reshape((n_components, 256)))
+
+
+def decode_blocks(data, components, dc_tables, ac_tables):
+    """Decode Huffman coded scan data back into zigzag ordered blocks
+
+    components gives the component index of each block in scan order, and
+    dc_tables and ac_tables the HuffmanTable of each component.  Returns an
+    (n_blocks, 64) array."""
+    components = np.asarray(components).tolist()
+    dc_lookups = [table._lookup for table in dc_tables]
+    ac_lookups = [table._lookup for table in ac_tables]
+    peek_shift = LOOKUP_BITS
+    peek_mask = (1 << LOOKUP_BITS) - 1
+
+    reader = BitReader(data)
+    fill = reader.fill
+    min_bits = reader.MIN_BITS
+    acc = n_bits = 0
+
+    # DC values of every block, and the flat index and value of each
+    # nonzero AC coefficient
+    dc_values = []
+    ac_index = []
+    ac_values = []
+    add_index = ac_index.append
+    add_value = ac_values.append
+    predictors = [0] * len(dc_tables)
+
+    for block, comp in enumerate(components):
+        if n_bits < min_bits:
+            acc, n_bits = fill(acc, n_bits)
+        length, run, size, value = (
+            dc_lookups[comp][(acc >> (n_bits - peek_shift)) & peek_mask] or
+            dc_tables[comp]._decode_long((acc >> (n_bits - 16)) & 0xFFFF))
+        n_bits -= length
+        if value is None:
+            # Only codes longer than LOOKUP_BITS leave a size 0 value unset
+            value = 0
+            if size:
+                n_bits -= size
+                value = (acc >> n_bits) & ((1 << size) - 1)
+                if value < (1 << (size - 1)):
+                    value -= (1 << size) - 1
+        predictors[comp] += value
+        dc_values.append(predictors[comp])
+
+        lookup = ac_lookups[comp]
+        table = ac_tables[comp]
+        k = block * 64 + 1
+        end = k + 63
+        while k < end:
+            if n_bits < min_bits:
+                acc, n_bits = fill(acc, n_bits)
+            length, run, size, value = (
+                lookup[(acc >> (n_bits - peek_shift)) & peek_mask] or
+                table._decode_long((acc >> (n_bits - 16)) & 0xFFFF))
+            n_bits -= length
+            if size:
+                if value is None:
+                    n_bits -= size
+                    value = (acc >> n_bits) & ((1 << size) - 1)
+                    if value < (1 << (size - 1)):
+                        value -= (1 << size) - 1
+                k += run
+                if k >= end:
+                    raise ValueError("AC coefficients run past the end of "
+                                     "a block")
+                add_index(k)
+                add_value(value)
+                k += 1
+            elif run == 15:
+                k += 16
+            else:
+                break
+
+    if reader.padding > n_bits:
+        raise ValueError("Scan data ended before all blocks were decoded")
+
+    zz = np.zeros((len(components), 64), dtype=np.int64)
+    zz[:, 0] = dc_values
+    zz.ravel()[ac_index] = ac_values
+    return zz
+
+
+def split_restart_intervals(data):
+    """Split entropy coded scan data into its restart intervals, returned as
+    memoryview slices of data"""
+    view = memoryview(data).cast('B')
+    segments = []
+    start = 0
+    for marker in _RESTART_MARKER.finditer(view):
+        segments.append(view[start:marker.start()])
+        start = marker.end()
+    segments.append(view[start:])
+    return segments
+
+
+def decode_intervals(segments, components, dc_tables, ac_tables,
+                     restart_interval):
+    """Decode a sequence of restart intervals, as returned by
+    split_restart_intervals, back into zigzag ordered blocks
+
+    Each interval holds restart_interval blocks, except the last which may
+    be shorter, and is decoded with its own DC predictions.  Returns an
+    (n_blocks, 64) array."""
+    components = np.asarray(components)
+    n_intervals = -(-components.size // restart_interval)
+    if len(segments) != n_intervals:
+        raise ValueError("Scan has {} restart intervals, expected {}".format(
+            len(segments), n_intervals))
+
+    blocks = [decode_blocks(segment,
+                            components[n * restart_interval:
+                                       (n + 1) * restart_interval],
+                            dc_tables, ac_tables)
+              for n, segment in enumerate(segments)]
+
+    return np.concatenate(blocks) if blocks else np.empty((0, 64), np.int64)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+import numpy as np
+
+from Sandbox.jpeg.huffman import HuffmanTable, ZIGZAG, UNZIGZAG
+
+"""
+Baseline JFIF file writing and reading
+
+A file is a sequence of marker segments: SOI, APP0 (JFIF header), DQT
+(quantization tables), SOF0 (baseline frame header), DHT (Huffman tables),
+an optional DRI (restart interval), SOS (scan header) followed by the
+entropy coded scan data, and EOI.
+"""
+
+# Marker codes (second byte of the 0xFF xx marker)
+SOI = 0xD8
+EOI = 0xD9
+APP0 = 0xE0
+DQT = 0xDB
+SOF0 = 0xC0
+DHT = 0xC4
+SOS = 0xDA
+DRI = 0xDD
+RST0 = 0xD0
+RST7 = 0xD7
+
+# Markers without a length field
+_STANDALONE_MARKERS = set(range(RST0, RST7 + 1)) | {SOI, EOI, 0x01}
+
+# Pseudo marker used when yielding the entropy coded data that follows SOS
+SCAN_DATA = 0x100
+
+
+class FrameComponent(object):
+    """One component of a frame: its id, sampling factors and the tables it
+    uses"""
+    def __init__(self, component_id, h_sampling=1, v_sampling=1,
+                 quant_table=0, dc_table=0, ac_table=0):
+        self.component_id = component_id
+        self.h_sampling = h_sampling
+        self.v_sampling = v_sampling
+        self.quant_table = quant_table
+        self.dc_table = dc_table
+        self.ac_table = ac_table
+
+
+class JfifData(object):
+    """Contents of a baseline JFIF file
+
+    quant_tables maps table ids to 8x8 tables in natural (raster) order and
+    dc_tables and ac_tables map table ids to HuffmanTables.
+    restart_interval is the number of MCUs between the restart markers of
+    the scan data, or 0 for none."""
+    def __init__(self, height=0, width=0, components=None, quant_tables=None,
+                 dc_tables=None, ac_tables=None, scan_data=b'',
+                 restart_interval=0):
+        self.height = height
+        self.width = width
+        self.components = components if components is not None else []
+        self.quant_tables = quant_tables if quant_tables is not None else {}
+        self.dc_tables = dc_tables if dc_tables is not None else {}
+        self.ac_tables = ac_tables if ac_tables is not None else {}
+        self.scan_data = scan_data
+        self.restart_interval = restart_interval
+
+
+def _segment(marker, payload=b''):
+    """Return a marker segment with its length field"""
+    return struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+
+
+def assign_table_ids(tables):
+    """Assign table ids to a list of per component tables, sharing an id
+    between components that use the same table.  Returns the ids and the
+    unique tables."""
+    unique = []
+    ids = []
+    for table in tables:
+        for n, other in enumerate(unique):
+            if table is other or (isinstance(table, np.ndarray) and
+                                  np.array_equal(table, other)):
+                ids.append(n)
+                break
+        else:
+            ids.append(len(unique))
+            unique.append(table)
+
+    return ids, unique
+
+
+def write_jfif(fileobj, data):
+    """Write a JfifData to a binary file-like object as a baseline JFIF"""
+    write_header(fileobj, data)
+    fileobj.write(data.scan_data)
+    write_trailer(fileobj)
+
+
+def write_header(fileobj, data):
+    """Write the segments of a JfifData up to and including SOS
+
+    Together with write_trailer this lets the scan data be written to the
+    file as it is coded, rather than held in data.scan_data."""
+    fileobj.write(struct.pack('>BB', 0xFF, SOI))
+
+    # JFIF 1.01, no units, 1:1 pixel aspect ratio, no thumbnail
+    fileobj.write(_segment(APP0, b'JFIF\x00' +
+                           struct.pack('>BBBHHBB', 1, 1, 0, 1, 1, 0, 0)))
+
+    for table_id, table in sorted(data.quant_tables.items()):
+        values = np.asarray(table).ravel()[ZIGZAG]
+        if np.any(values < 1) or np.any(values > 255):
+            raise ValueError("Baseline quantization tables must be in the "
+                             "range 1 to 255")
+        fileobj.write(_segment(DQT, bytes([table_id]) +
+                               values.astype(np.uint8).tobytes()))
+
+    frame = struct.pack('>BHHB', 8, data.height, data.width,
+                        len(data.components))
+    for comp in data.components:
+        frame += struct.pack('>BBB', comp.component_id,
+                             (comp.h_sampling << 4) | comp.v_sampling,
+                             comp.quant_table)
+    fileobj.write(_segment(SOF0, frame))
+
+    for table_class, tables in [(0, data.dc_tables), (1, data.ac_tables)]:
+        for table_id, table in sorted(tables.items()):
+            payload = (bytes([(table_class << 4) | table_id]) +
+                       table.bits.astype(np.uint8).tobytes() +
+                       table.values.astype(np.uint8).tobytes())
+            fileobj.write(_segment(DHT, payload))
+
+    if data.restart_interval:
+        fileobj.write(_segment(DRI, struct.pack('>H',
+                                                data.restart_interval)))
+
+    scan = struct.pack('>B', len(data.components))
+    for comp in data.components:
+        scan += struct.pack('>BB', comp.component_id,
+                            (comp.dc_table << 4) | comp.ac_table)
+    scan += struct.pack('>BBB', 0, 63, 0)
+    fileobj.write(_segment(SOS, scan))
+
+
+def write_trailer(fileobj):
+    """Write the EOI marker that ends a JFIF file"""
+    fileobj.write(struct.pack('>BB', 0xFF, EOI))
+
+
+class _StreamBuffer(object):
+    """Reads exact byte counts and entropy coded data from a stream while
+    holding only one chunk of look-ahead in memory"""
+    def __init__(self, fileobj, chunk_size):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._buffer = b''
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            chunk = self._fileobj.read(self._chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of JPEG stream")
+            self._buffer += chunk
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def read_scan(self):
+        """Read entropy coded data up to, but not including, the next marker
+        that is not a stuffed zero or a restart marker"""
+        pieces = []
+        start = 0
+        while True:
+            pos = self._buffer.find(b'\xff', start)
+            while pos >= 0 and pos + 1 < len(self._buffer):
+                next_byte = self._buffer[pos + 1]
+                if next_byte != 0 and not RST0 <= next_byte <= RST7:
+                    pieces.append(self._buffer[:pos])
+                    self._buffer = self._buffer[pos:]
+                    return b''.join(pieces)
+                pos = self._buffer.find(b'\xff', pos + 2)
+
+            # Keep a trailing 0xFF until the byte after it has been read
+            keep = 1 if self._buffer.endswith(b'\xff') else 0
+            pieces.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            start = 0
+
+            chunk = self._fileobj.read(self._chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of JPEG stream")
+            self._buffer += chunk
+
+
+def read_segments(fileobj, chunk_size=1 << 16):
+    """Yield the (marker, payload) segments of a JPEG stream as they are read
+
+    The entropy coded data following an SOS segment is yielded with the
+    pseudo marker SCAN_DATA.  Reading stops after EOI."""
+    stream = _StreamBuffer(fileobj, chunk_size)
+
+    if stream.read(2) != b'\xff\xd8':
+        raise ValueError("Not a JPEG stream (missing SOI marker)")
+    yield SOI, b''
+
+    while True:
+        prefix, marker = stream.read(2)
+        while marker == 0xFF:
+            # Fill bytes may precede a marker
+            marker = stream.read(1)[0]
+        if prefix != 0xFF:
+            raise ValueError("Expected a marker, got byte {:#04x}".format(
+                prefix))
+
+        if marker in _STANDALONE_MARKERS:
+            yield marker, b''
+            if marker == EOI:
+                return
+            continue
+
+        length, = struct.unpack('>H', stream.read(2))
+        yield marker, stream.read(length - 2)
+
+        if marker == SOS:
+            yield SCAN_DATA, stream.read_scan()
+
+
+def _parse_dqt(payload, quant_tables):
+    pos = 0
+    while pos < len(payload):
+        precision, table_id = divmod(payload[pos], 16)
+        dtype = '>u2' if precision else 'u1'
+        size = 128 if precision else 64
+        values = np.frombuffer(payload[pos + 1:pos + 1 + size], dtype=dtype)
+        quant_tables[table_id] = values[UNZIGZAG].reshape((8, 8)).astype(int)
+        pos += 1 + size
+
+
+def _parse_dht(payload, dc_tables, ac_tables):
+    pos = 0
+    while pos < len(payload):
+        table_class, table_id = divmod(payload[pos], 16)
+        bits = list(payload[pos + 1:pos + 17])
+        n_values = sum(bits)
+        values = list(payload[pos + 17:pos + 17 + n_values])
+        tables = ac_tables if table_class else dc_tables
+        tables[table_id] = HuffmanTable(bits, values)
+        pos += 17 + n_values
+
+
+def read_jfif(fileobj, chunk_size=1 << 16):
+    """Read a baseline JFIF from a binary file-like object into a JfifData
+
+    Segments are parsed as they are read from the stream, so only the scan
+    data is held in memory."""
+    data = JfifData()
+    components = {}
+
+    for marker, payload in read_segments(fileobj, chunk_size):
+        if marker == DQT:
+            _parse_dqt(payload, data.quant_tables)
+        elif marker == DHT:
+            _parse_dht(payload, data.dc_tables, data.ac_tables)
+        elif marker == SOF0:
+            precision, data.height, data.width, n_comps = struct.unpack(
+                '>BHHB', payload[:6])
+            if precision != 8:
+                raise ValueError("Only 8-bit baseline JPEG is supported")
+            for n in range(n_comps):
+                comp_id, sampling, table = payload[6 + 3 * n:9 + 3 * n]
+                comp = FrameComponent(comp_id, sampling >> 4, sampling & 15,
+                                      table)
+                components[comp_id] = comp
+                data.components.append(comp)
+        elif marker in range(0xC1, 0xD0) and marker not in (DHT, 0xC8, 0xCC):
+            raise ValueError("Only baseline (SOF0) JPEG is supported")
+        elif marker == SOS:
+            n_comps = payload[0]
+            if n_comps != len(data.components):
+                raise ValueError("Only single interleaved scans are supported")
+            for n in range(n_comps):
+                comp_id, tables = payload[1 + 2 * n:3 + 2 * n]
+                components[comp_id].dc_table = tables >> 4
+                components[comp_id].ac_table = tables & 15
+        elif marker == DRI:
+            data.restart_interval, = struct.unpack('>H', payload[:2])
+        elif marker == SCAN_DATA:
+            data.scan_data = payload
+
+    return data
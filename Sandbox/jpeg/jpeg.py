@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import io
+import itertools
+
 import numpy as np
 
-from Sandbox.utils.image_utils import split_image, unsplit_image
-from Sandbox.utils.dct import dct2, idct2
+from Sandbox.utils.image_utils import (block_view, unsplit_image, pad_image,
+                                       downsample, upsample)
+from Sandbox.utils.dct import (block_dct2, block_idct2, fixed_block_dct8,
+                               fixed_block_idct8, AAN_SCALE, AAN_FDCT_BITS,
+                               AAN_IDCT_BITS)
+from Sandbox.jpeg import huffman, parallel
+from Sandbox.jpeg.jfif import (JfifData, FrameComponent, read_jfif, write_jfif,
+                               write_header, write_trailer, assign_table_ids)
 
 """
 JPEG algorithm steps
@@ -15,86 +25,984 @@ JPEG algorithm steps
 6) Perform lossless compression of result with Huffman encoding
 """
 
+# Scale factors that convert the unnormalized 8x8 DCT of block_dct2 into the
+# normalized DCT used by JPEG, F(u, v) = C(u) C(v) / 4 * sum(...)
+_C = np.array([1 / np.sqrt(2)] + [1.0] * 7)
+DCT_SCALE = np.outer(_C, _C) / 4
+
+# Relates the fixed-point AAN transforms to block_dct2, see Sandbox.utils.dct
+_AAN_SCALE_2D = np.outer(AAN_SCALE, AAN_SCALE)
+
+# Scale denominators supported by JpegCompressor.decompress(reduction=...)
+REDUCTIONS = (1, 2, 4, 8)
+
+# DCT implementations selectable with JpegCompressor(engine=...)
+ENGINES = ('float', 'fixed')
+
+# Luma (h, v) sampling factors of each chroma subsampling mode.  Chroma is
+# always sampled at (1, 1).
+SUBSAMPLING_MODES = {'4:4:4': (1, 1), '4:2:2': (2, 1), '4:2:0': (2, 2)}
+
+
+class _NoStats(object):
+    """Stand-in for the stage recorder of Sandbox.jpeg.stats when stats are
+    off, like contextlib.nullcontext (which needs Python 3.7)"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STATS = _NoStats()
+
+
+# IJG base quantization tables (JPEG Annex K.1), used unscaled at quality 50
+LUMA_QUANT_TABLE = np.array([[16, 11, 10, 16, 24, 40, 51, 61],
+                             [12, 12, 14, 19, 26, 58, 60, 55],
+                             [14, 13, 16, 24, 40, 57, 69, 56],
+                             [14, 17, 22, 29, 51, 87, 80, 62],
+                             [18, 22, 37, 56, 68, 109, 103, 77],
+                             [24, 35, 55, 64, 81, 104, 113, 92],
+                             [49, 64, 78, 87, 103, 121, 120, 101],
+                             [72, 92, 95, 98, 112, 100, 103, 99]])
+CHROMA_QUANT_TABLE = np.array([[17, 18, 24, 47, 99, 99, 99, 99],
+                               [18, 21, 26, 66, 99, 99, 99, 99],
+                               [24, 26, 56, 99, 99, 99, 99, 99],
+                               [47, 66, 99, 99, 99, 99, 99, 99],
+                               [99, 99, 99, 99, 99, 99, 99, 99],
+                               [99, 99, 99, 99, 99, 99, 99, 99],
+                               [99, 99, 99, 99, 99, 99, 99, 99],
+                               [99, 99, 99, 99, 99, 99, 99, 99]])
+
+
+@functools.lru_cache(maxsize=32)
+def quantization_tables(quality):
+    """Return the read-only (luma, chroma) quantization tables for an IJG
+    quality factor from 1 (smallest files) to 100 (best fidelity), and
+    their reciprocals
+
+    The tables are cached, so compressors with the same quality share them.
+    Values are limited to 1 to 255 as baseline JPEG requires."""
+    if quality != int(quality):
+        raise ValueError("quality must be an integer")
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    quality = int(quality)
+
+    # IJG jcparam.c scaling: 50 keeps the base tables
+    scale = 5000 // quality if quality < 50 else 200 - 2 * quality
+
+    tables = []
+    reciprocals = []
+    for base in (LUMA_QUANT_TABLE, CHROMA_QUANT_TABLE):
+        table = np.clip((base * scale + 50) // 100, 1, 255)
+        reciprocal = 1.0 / table
+        table.flags.writeable = False
+        reciprocal.flags.writeable = False
+        tables.append(table)
+        reciprocals.append(reciprocal)
+
+    return tuple(tables), tuple(reciprocals)
+
+
+@functools.lru_cache(maxsize=32)
+def _fixed_reciprocals(quality):
+    """Return read-only float32 (luma, chroma) quantization multipliers for
+    the output of fixed_block_dct8, with the AAN scale and JPEG's DCT
+    normalization folded in"""
+    multipliers = []
+    for table in quantization_tables(quality)[0]:
+        multiplier = (DCT_SCALE / (table * _AAN_SCALE_2D *
+                                   2**AAN_FDCT_BITS)).astype(np.float32)
+        multiplier.flags.writeable = False
+        multipliers.append(multiplier)
+
+    return tuple(multipliers)
+
+
+def _fixed_dequantizers(table):
+    """Return float32 multipliers that dequantize coefficients into the
+    scaled input of fixed_block_idct8"""
+    return (np.asarray(table) * _AAN_SCALE_2D * 2**AAN_IDCT_BITS /
+            (64 * DCT_SCALE)).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=4)
+def _reduced_dct_scale(size):
+    """Return scale factors that convert the low size x size frequencies of
+    JPEG's normalized 8x8 DCT into the unnormalized size-point DCT of
+    block_idct2, giving a size x size decode of each block
+
+    size=8 gives DCT_SCALE."""
+    norm = np.array([np.sqrt(1 / size)] + [np.sqrt(2 / size)] * (size - 1))
+    scale = norm / np.sqrt(size / 8)
+    scale = np.outer(scale, scale)
+    scale.flags.writeable = False
+    return scale
+
+
+@functools.lru_cache(maxsize=16)
+def _gamma_table(gamma, dtype=np.dtype(np.float64)):
+    """Return a read-only 256 entry gamma correction lookup table for 8-bit
+    pixel values"""
+    table = ((np.arange(256) / 255.0)**gamma).astype(dtype)
+    table.flags.writeable = False
+    return table
+
+
+def component_grids(height, width, sampling):
+    """Return the (rows, cols) block grid of each component of an image
+
+    sampling gives the (h, v) sampling factors of each component.  Every
+    component covers a whole number of minimum coded units (MCUs)."""
+    h_max = max(h for h, v in sampling)
+    v_max = max(v for h, v in sampling)
+    mcu_rows = -(-height // (8 * v_max))
+    mcu_cols = -(-width // (8 * h_max))
+
+    return [(mcu_rows * v, mcu_cols * h) for h, v in sampling]
+
+
+class CompressedImage(object):
+    """Quantized DCT coefficients plus the geometry needed to decode them
+
+    coefficients holds one (rows, cols, 8, 8) block array per Y'CbCr
+    component and quant_tables the matching quantization tables.  sampling
+    gives the (h, v) sampling factors of each component, (1, 1) for all
+    components when there is no chroma subsampling.  height and width are the
+    original image size, before the image was padded out to a whole number of
+    blocks."""
+    def __init__(self, coefficients, height, width, quant_tables,
+                 block_shape=(8, 8), sampling=None):
+        self.coefficients = list(coefficients)
+        self.height = height
+        self.width = width
+        self.quant_tables = list(quant_tables)
+        self.block_shape = tuple(block_shape)
+        if sampling is None:
+            sampling = [(1, 1)] * len(self.coefficients)
+        self.sampling = [tuple(factors) for factors in sampling]
+
+    @property
+    def grid(self):
+        """(rows, cols) of luma blocks covering the padded image"""
+        return self.coefficients[0].shape[:2]
+
+    @property
+    def padding(self):
+        """(rows, cols) of pixels added to the bottom and right edges"""
+        rows, cols = self.grid
+        return (rows * self.block_shape[0] - self.height,
+                cols * self.block_shape[1] - self.width)
+
+    @property
+    def dtype(self):
+        """Data type of the quantized coefficients"""
+        return self.coefficients[0].dtype
+
+    @property
+    def size(self):
+        """Total number of quantized coefficients"""
+        return sum(coeffs.size for coeffs in self.coefficients)
+
 
 class JpegCompressor(object):
-    """JPEG Compression class"""
-    def __init__(self):
+    """JPEG Compression class
+
+    gamma is the gamma correction applied to 8-bit RGB input before color
+    conversion.  Use gamma=1.0 to store the RGB values unchanged, as standard
+    JPEG decoders expect.
+
+    quality is the IJG quality factor, from 1 to 100, of the luma and chroma
+    quantization tables.
+
+    subsampling selects the chroma resolution: '4:4:4' (full resolution),
+    '4:2:2' (half horizontal) or '4:2:0' (half horizontal and vertical).
+
+    engine selects the DCT: 'float' uses float64 matrix products and 'fixed'
+    the int32 fixed-point AAN transforms, with the AAN scale folded into
+    quantization.  The fixed engine rounds subsampled chroma to integers
+    before the DCT.  Its quantized coefficients differ from the float
+    engine's by at most 1, for about 0.03% of coefficients at quality 75
+    and 1% at quality 100, and it decodes to within one 8-bit Y'CbCr level
+    of the float engine.
+
+    float_dtype is the floating point type of the color conversion and DCT
+    intermediates and coeff_dtype the integer type of the quantized
+    coefficients.  float32 and int16 halve the intermediate memory traffic
+    and quarter the coefficient memory of the float64 and int64 defaults.
+    int16 holds every baseline JPEG coefficient.
+
+    workers > 1 splits compress into horizontal bands of band_height pixels
+    (rounded up to a whole number of MCUs, by default an equal share of the
+    image per worker) that are encoded in a 'process' or 'thread' pool.  The
+    result is identical to the serial encoding.  Images of fewer than
+    PARALLEL_MIN_PIXELS pixels are encoded serially.  The pool is started on
+    first use and kept until close, or the end of a with block.  Process
+    workers read images from shared memory: images from shared_image are
+    read in place, and others are copied there first.
+
+    restart_interval > 0 writes a restart marker every restart_interval MCUs
+    of the entropy coded scan.  The intervals of such scans, whether written
+    by this compressor or read from a file, are entropy decoded in parallel
+    when workers > 1 and the scan has at least PARALLEL_MIN_PIXELS
+    coefficients.
+
+    optimize=True makes write code each image with optimal Huffman tables
+    built from its symbol frequencies, in a second pass over the quantized
+    coefficients, and store them in the file in place of the standard
+    tables.  Files are typically several percent smaller and decode with
+    any baseline decoder.
+
+    stats is an optional Sandbox.jpeg.stats.PipelineStats that records the
+    wall time, bytes processed and peak memory of each stage of compress and
+    decompress: rgb_to_ycbcr, split (padding to whole MCUs and into blocks),
+    downsample (of subsampled components only), dct, quantize (folded into
+    dct by the fixed engine), entropy_encode, entropy_decode, dequantize,
+    idct, reassemble (of blocks into planes), upsample (of subsampled
+    components only) and ycbcr_to_rgb, as well as entropy_optimize for the
+    frequency pass of optimize and encode_bands for the whole of a parallel
+    compress.  Stages run by process workers are recorded without their
+    peak memory."""
+    # Pixels color converted and transformed together by compress_many and
+    # decompress_many.  Larger passes are slowed down by cache misses.
+    BATCH_PIXELS = 1 << 15
+
+    # MCU rows sampled by the quality search of compress_to_size
+    SIZE_SAMPLE_ROWS = 16
+
+    # Smallest image coded by the worker pool.  Smaller images take less
+    # time to code serially than to hand to workers.
+    PARALLEL_MIN_PIXELS = 1 << 18
+
+    def __init__(self, gamma=0.45, subsampling='4:4:4', quality=75,
+                 workers=1, band_height=None, pool='process', engine='float',
+                 float_dtype=np.float64, coeff_dtype=np.int64,
+                 restart_interval=0, optimize=False, stats=None):
+        self.gamma = gamma
+        self.stats = stats
+
+        self.float_dtype = np.dtype(float_dtype)
+        self.coeff_dtype = np.dtype(coeff_dtype)
+        if self.float_dtype.kind != 'f':
+            raise ValueError("float_dtype must be a floating point type")
+        if self.coeff_dtype.kind != 'i' or self.coeff_dtype.itemsize < 2:
+            raise ValueError("coeff_dtype must be a signed integer type of "
+                             "at least 16 bits")
+
+        if engine not in ENGINES:
+            raise ValueError("Unsupported engine. Only 'float' or 'fixed' "
+                             "is valid")
+        self.engine = engine
+
+        if pool not in ('process', 'thread'):
+            raise ValueError("Unsupported pool. Only 'process' or 'thread' "
+                             "is valid")
+        self.workers = workers
+        self.band_height = band_height
+        self.pool = pool
+        self._workers = None
+
+        if not 0 <= restart_interval <= 0xFFFF:
+            raise ValueError("restart_interval must be between 0 and 65535")
+        self.restart_interval = restart_interval
+        self.optimize = optimize
+
+        if subsampling not in SUBSAMPLING_MODES:
+            raise ValueError("Unsupported subsampling mode. Valid modes are "
+                             + ", ".join(sorted(SUBSAMPLING_MODES)))
+        self.subsampling = subsampling
+        self.sampling = [SUBSAMPLING_MODES[subsampling], (1, 1), (1, 1)]
+
         # Color concversion constants from ITU-R BT.601 specification
         self._k_r = 0.299
         self._k_g = 0.587
         self._k_b = 0.114
 
-        # IJG Standard Quantization Table
-        self.Q = np.array([[16, 11, 10, 16, 24, 40, 51, 61],
-                           [12, 12, 14, 19, 26, 58, 60, 55],
-                           [14, 13, 16, 24, 40, 57, 69, 56],
-                           [14, 17, 22, 29, 51, 87, 80, 62],
-                           [18, 22, 37, 56, 68, 109, 103, 77],
-                           [24, 35, 55, 64, 81, 104, 113, 92],
-                           [49, 64, 78, 87, 103, 121, 120, 101],
-                           [72, 92, 95, 98, 112, 100, 103, 99]])
+        # Y'PbPr rows as a matrix acting on (R', G', B') column vectors
+        k_r, k_g, k_b = self._k_r, self._k_g, self._k_b
+        self._rgb_to_ypbpr = np.array([
+            [k_r, k_g, k_b],
+            [-0.5 * k_r / (1 - k_b), -0.5 * k_g / (1 - k_b), 0.5],
+            [0.5, -0.5 * k_g / (1 - k_r), -0.5 * k_b / (1 - k_r)]])
+        self._ypbpr_to_rgb = np.linalg.inv(self._rgb_to_ypbpr)
+
+        # Quantization tables of the Y, Cb and Cr components
+        self.quality = quality
+        tables, reciprocals = quantization_tables(quality)
+        self.Q = tables[0]
+        self.quant_tables = [tables[0], tables[1], tables[1]]
+        self._quant_reciprocals = [
+            reciprocal.astype(self.float_dtype, copy=False)
+            for reciprocal in (reciprocals[0], reciprocals[1], reciprocals[1])]
+        self._dct_scale = DCT_SCALE.astype(self.float_dtype)
+        fixed = _fixed_reciprocals(quality)
+        self._fixed_reciprocals = [fixed[0], fixed[1], fixed[1]]
+
+        # Standard Huffman tables for the Y, Cb and Cr components
+        self.dc_tables = [huffman.DC_LUMINANCE, huffman.DC_CHROMINANCE,
+                          huffman.DC_CHROMINANCE]
+        self.ac_tables = [huffman.AC_LUMINANCE, huffman.AC_CHROMINANCE,
+                          huffman.AC_CHROMINANCE]
 
     def compress(self, rgb_image):
-        """Returns JPEG compressed image data"""
-        ycbcr_image = self.rgb_to_ycbcr(rgb_image)
+        """Returns JPEG compressed image data as a CompressedImage"""
+        height, width = rgb_image.shape[:2]
+
+        if self.workers > 1 and height * width >= self.PARALLEL_MIN_PIXELS:
+            grids = component_grids(height, width, self.sampling)
+            mcu_height = 8 * max(v for h, v in self.sampling)
+            n_mcu_rows = grids[0][0] // self.sampling[0][1]
+            if self.band_height is None:
+                band_mcu_rows = -(-n_mcu_rows // self.workers)
+            else:
+                band_mcu_rows = max(-(-self.band_height // mcu_height), 1)
+
+            with self._stage('encode_bands', rgb_image):
+                quant_blocks = self._worker_pool().encode_bands(
+                    self, rgb_image, grids, band_mcu_rows)
+        else:
+            quant_blocks = self.quantized_blocks(rgb_image)
+
+        return CompressedImage(quant_blocks, height, width, self.quant_tables,
+                               sampling=self.sampling)
+
+    def shared_image(self, shape, dtype=np.uint8):
+        """Return an empty image array that the process pool workers of
+        compress read in place, rather than copying the image to shared
+        memory"""
+        return self._worker_pool().shared_array(shape, dtype)
+
+    def close(self):
+        """Shut down the worker pool, if one was started"""
+        if self._workers is not None:
+            self._workers.close()
+            self._workers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        # Pool workers are sent the compressor without its pool
+        state = self.__dict__.copy()
+        state['_workers'] = None
+        return state
+
+    def _worker_pool(self):
+        if self._workers is None:
+            self._workers = parallel.WorkerPool(self.workers, self.pool)
+        return self._workers
+
+    def compress_to_size(self, rgb_image, max_bytes):
+        """Compress an rgb image at the highest quality whose JFIF file, as
+        written by write, fits in max_bytes
+
+        The DCT is computed, and its blocks put in scan order, once.  Only
+        quantization and entropy coding are repeated: a binary search over
+        quality estimates sizes from the code lengths of a sample of MCU
+        rows, the estimate is then refined on the whole image, and the final
+        candidate is checked by writing it.  With optimize, sizes are
+        estimated with the optimal tables of each quality.  The search uses
+        the float transform with either engine.  Returns a CompressedImage
+        and raises ValueError if even quality 1 is too large."""
+        height, width = rgb_image.shape[:2]
+        grids = component_grids(height, width, self.sampling)
+        zz_dct, components = huffman.interleave(
+            list(self.dct_blocks(rgb_image)), self.sampling)
+        blocks_per_mcu = sum(h * v for h, v in self.sampling)
+        mcu_components = components[:blocks_per_mcu]
+        zz_dct = zz_dct.reshape((-1, blocks_per_mcu, 64))
+
+        # Every step-th row of MCUs, about SIZE_SAMPLE_ROWS rows in all
+        n_mcu_rows = grids[0][0] // self.sampling[0][1]
+        step = max(n_mcu_rows // self.SIZE_SAMPLE_ROWS, 1)
+        sample = zz_dct.reshape((n_mcu_rows, -1) + zz_dct.shape[1:])[::step]
+        sample = np.ascontiguousarray(sample).reshape(
+            (-1,) + zz_dct.shape[1:])
+        sample_scale = zz_dct.shape[0] / len(sample)
+
+        stream = io.BytesIO()
+        write_header(stream, self._jfif_data(height, width, self.quant_tables,
+                                             self.sampling))
+        write_trailer(stream)
+        overhead = len(stream.getvalue())
+
+        def quantize(quality, blocks=zz_dct):
+            """Return the (n_blocks, 64) quantized scan of a quality"""
+            reciprocals = quantization_tables(quality)[1]
+            mcu_reciprocals = huffman.zigzag(np.stack(
+                [reciprocals[min(comp, 1)] for comp in mcu_components]))
+            with self._stage('quantize', blocks):
+                scaled = blocks * mcu_reciprocals.astype(self.float_dtype)
+                np.rint(scaled, out=scaled)
+            return scaled.astype(self.coeff_dtype).reshape((-1, 64))
+
+        def estimated_size(quality, blocks=zz_dct, scale=1):
+            zz = quantize(quality, blocks)
+            dc_tables, ac_tables = self.dc_tables, self.ac_tables
+            if self.optimize:
+                dc_tables, ac_tables = self._optimal_tables(
+                    zz, components[:len(zz)], 0)
+            with self._stage('entropy_estimate', zz):
+                n_bits = huffman.scan_bits(zz, components[:len(zz)],
+                                           dc_tables, ac_tables)
+            return overhead + int(np.ceil(n_bits * scale / 8))
+
+        # Binary search for the highest quality whose sample fits
+        low, high = 1, 100
+        while low < high:
+            quality = (low + high + 1) // 2
+            if estimated_size(quality, sample, sample_scale) <= max_bytes:
+                low = quality
+            else:
+                high = quality - 1
 
-        blocks_y = split_image(ycbcr_image[:, :, 0])
-        blocks_cb = split_image(ycbcr_image[:, :, 1])
-        blocks_cr = split_image(ycbcr_image[:, :, 2])
+        # Move to the boundary estimated from the whole image
+        quality = low
+        if estimated_size(quality) <= max_bytes:
+            while quality < 100 and estimated_size(quality + 1) <= max_bytes:
+                quality += 1
+        else:
+            while quality > 1 and estimated_size(quality) > max_bytes:
+                quality -= 1
 
-        # TODO: need to subtract 128 to center data on 0 prior to DCT
-        dct_blocks = []
-        for blocks in [blocks_y, blocks_cb, blocks_cr]:
-            dct_blocks.append(list(map(dct2, blocks)))
+        # Byte stuffing and restart markers are not in the estimate
+        for quality in range(quality, 0, -1):
+            tables = quantization_tables(quality)[0]
+            compressed = CompressedImage(
+                huffman.deinterleave(quantize(quality), grids, self.sampling),
+                height, width, [tables[0], tables[1], tables[1]],
+                sampling=self.sampling)
+            stream = io.BytesIO()
+            self.write(compressed, stream)
+            if len(stream.getvalue()) <= max_bytes:
+                return compressed
 
-        dct_blocks = np.array(dct_blocks)
-        quant_blocks = self.quantize_freqs(dct_blocks)
+        raise ValueError("Image does not fit in {} bytes even at quality "
+                         "1".format(max_bytes))
+
+    def quantized_blocks(self, rgb_image):
+        """Color convert, transform and quantize an rgb image, returning the
+        (rows, cols, 8, 8) quantized coefficients of each component
+
+        A (batch, height, width, 3) stack of images gives
+        (batch, rows, cols, 8, 8) coefficients."""
+        if self.engine == 'fixed':
+            quant_blocks = []
+            for chan, blocks in enumerate(self._component_blocks(rgb_image)):
+                with self._stage('dct', blocks):
+                    quant_blocks.append(self._quantize_fixed(blocks, chan))
+            return quant_blocks
+
+        quant_blocks = []
+        for chan, dct_blocks in enumerate(self.dct_blocks(rgb_image)):
+            with self._stage('quantize', dct_blocks):
+                quant_blocks.append(self.quantize_freqs(dct_blocks, chan))
 
         return quant_blocks
 
-    def decompress(self, jpeg_image):
-        """Decompresses jpeg data into an rgb image"""
-        unquant_img = jpeg_image * self.Q
-        ycbcr_blocks = [list(map(idct2, blocks)) for blocks in unquant_img]
+    def dct_blocks(self, rgb_image):
+        """Color convert and transform an rgb image, yielding the unquantized
+        (rows, cols, 8, 8) DCT coefficients of each component with JPEG's
+        normalization, computed with the float transform"""
+        for blocks in self._component_blocks(rgb_image):
+            # Center the data on 0 and use JPEG's DCT normalization
+            with self._stage('dct', blocks):
+                dct_blocks = block_dct2(np.subtract(blocks, 128,
+                                                    dtype=self.float_dtype))
+                dct_blocks *= self._dct_scale
+            yield dct_blocks
+
+    def _component_blocks(self, rgb_image):
+        """Color convert, pad and downsample an rgb image, yielding each
+        component as a (rows, cols, 8, 8) grid of blocks"""
+        with self._stage('rgb_to_ycbcr', rgb_image):
+            ycbcr_image = self.rgb_to_ycbcr(rgb_image)
+
+        h_max = max(h for h, v in self.sampling)
+        v_max = max(v for h, v in self.sampling)
+        for plane, (h, v) in zip(np.moveaxis(ycbcr_image, -1, 0),
+                                 self.sampling):
+            # Pad each channel out to a whole number of MCUs and view it as
+            # a (rows, cols, 8, 8) grid of blocks
+            with self._stage('split', plane):
+                plane = pad_image(plane, (8 * v_max, 8 * h_max))
+                blocks = block_view(plane)
+
+            # Box filter subsampled channels
+            factors = (v_max // v, h_max // h)
+            if factors != (1, 1):
+                with self._stage('downsample', plane):
+                    blocks = block_view(downsample(plane, factors,
+                                                   self.float_dtype))
+            yield blocks
+
+    def _quantize_fixed(self, blocks, component):
+        """Level shift, transform and quantize blocks with the fixed-point
+        engine"""
+        if blocks.dtype.kind == 'f':
+            blocks = np.rint(blocks)
+
+        return fixed_block_dct8(blocks, offset=128,
+                                multipliers=self._fixed_reciprocals[component],
+                                dtype=self.coeff_dtype)
+
+    def decompress(self, jpeg_image, reduction=1):
+        """Decompresses a CompressedImage into an rgb image
+
+        reduction of 2, 4 or 8 decodes the image at 1/2, 1/4 or 1/8 scale,
+        rounded up, by inverse transforming only the low 4x4 or 2x2
+        frequencies of each block, or taking just the DC coefficient.  This
+        is much faster than decoding and shrinking the full image.  Reduced
+        decodes always use the float transform."""
+        return self._decode_pixels(jpeg_image.coefficients,
+                                   jpeg_image.quant_tables,
+                                   jpeg_image.sampling, jpeg_image.height,
+                                   jpeg_image.width, reduction)
+
+    def decompress_region(self, jpeg_image, top, left, height, width):
+        """Decompress the height x width pixel rectangle at (top, left) of a
+        CompressedImage into an rgb image
+
+        Only the MCUs intersecting the rectangle are inverse transformed, so
+        the cost is proportional to the region, not the image.  The result
+        equals the same crop of decompress(jpeg_image).  The rectangle is
+        clipped to the image."""
+        bottom = min(top + height, jpeg_image.height)
+        right = min(left + width, jpeg_image.width)
+        top, left = max(top, 0), max(left, 0)
+        if top >= bottom or left >= right:
+            raise ValueError("Region does not intersect the image")
+
+        # Whole MCUs covering the region
+        h_max = max(h for h, v in jpeg_image.sampling)
+        v_max = max(v for h, v in jpeg_image.sampling)
+        mcu_height, mcu_width = 8 * v_max, 8 * h_max
+        row0, row1 = top // mcu_height, -(-bottom // mcu_height)
+        col0, col1 = left // mcu_width, -(-right // mcu_width)
+
+        coefficients = [coeffs[row0 * v:row1 * v, col0 * h:col1 * h]
+                        for coeffs, (h, v) in zip(jpeg_image.coefficients,
+                                                  jpeg_image.sampling)]
+        rgb_image = self._decode_pixels(coefficients, jpeg_image.quant_tables,
+                                        jpeg_image.sampling,
+                                        (row1 - row0) * mcu_height,
+                                        (col1 - col0) * mcu_width)
+
+        y0 = top - row0 * mcu_height
+        x0 = left - col0 * mcu_width
+        return rgb_image[y0:y0 + bottom - top, x0:x0 + right - left]
+
+    def compress_many(self, images):
+        """Compress a sequence of rgb images into a list of CompressedImages
+
+        Images of the same shape are stacked and color converted,
+        transformed and quantized together in one vectorized pass."""
+        images = [np.asarray(image) for image in images]
+        results = [None] * len(images)
+
+        groups = {}
+        for n, image in enumerate(images):
+            groups.setdefault((image.shape, image.dtype.str), []).append(n)
+
+        for (shape, _), group in groups.items():
+            height, width = shape[:2]
+            for indices in self._batches(group, height * width):
+                batch = self.quantized_blocks(np.stack([images[n]
+                                                        for n in indices]))
+                for k, n in enumerate(indices):
+                    results[n] = CompressedImage(
+                        [coeffs[k] for coeffs in batch], height, width,
+                        self.quant_tables, sampling=self.sampling)
 
-        # Hardcoded for astronaut image
-        ycbcr_list = [unsplit_image(x, (64, 64)) for x in ycbcr_blocks]
+        return results
 
-        ycbcr_image = np.stack(ycbcr_list, 2)
+    def decompress_many(self, payloads, reduction=1):
+        """Decompress a sequence of CompressedImages, or JFIF files as bytes,
+        into a list of rgb images, optionally reduced as in decompress
 
-        rgb_image = self.ycbcr_to_rgb(ycbcr_image)
+        Images with the same size and sampling are decoded together in one
+        vectorized pass."""
+        compressed = [self.read(io.BytesIO(payload))
+                      if isinstance(payload, (bytes, bytearray)) else payload
+                      for payload in payloads]
+        results = [None] * len(compressed)
+
+        groups = {}
+        for n, image in enumerate(compressed):
+            key = (image.height, image.width, tuple(image.sampling),
+                   tuple(coeffs.shape for coeffs in image.coefficients))
+            groups.setdefault(key, []).append(n)
+
+        for (height, width, sampling, _), group in groups.items():
+            for indices in self._batches(group, height * width):
+                batch = [compressed[n] for n in indices]
+                coefficients = [np.stack([image.coefficients[chan]
+                                          for image in batch])
+                                for chan in range(len(sampling))]
+                # (batch, 1, 1, 8, 8) tables broadcast over each block grid
+                quant_tables = [np.stack([image.quant_tables[chan]
+                                          for image in batch])[:, None, None]
+                                for chan in range(len(sampling))]
+
+                rgb_images = self._decode_pixels(coefficients, quant_tables,
+                                                 sampling, height, width,
+                                                 reduction)
+                for k, n in enumerate(indices):
+                    results[n] = rgb_images[k]
+
+        return results
+
+    def _batches(self, indices, n_pixels):
+        """Split a group of same-size images into batches of about
+        BATCH_PIXELS pixels, so the temporaries of a pass stay in cache"""
+        size = max(self.BATCH_PIXELS // n_pixels, 1)
+        return [indices[start:start + size]
+                for start in range(0, len(indices), size)]
+
+    def _decode_pixels(self, coefficients, quant_tables, sampling, height,
+                       width, reduction=1):
+        """Dequantize, inverse transform and color convert the
+        (..., rows, cols, 8, 8) coefficients of each component into
+        (..., height, width, 3) rgb images, reduced in size by reduction"""
+        if reduction not in REDUCTIONS:
+            raise ValueError("Unsupported reduction. Valid reductions are "
+                             + ", ".join(str(r) for r in REDUCTIONS))
+
+        size = 8 // reduction
+        lead = coefficients[0].shape[:-4]
+        rows, cols = coefficients[0].shape[-4:-2]
+        ycbcr_image = np.empty(lead + (rows * size, cols * size, 3),
+                               dtype=self.float_dtype)
+
+        h_max = max(h for h, v in sampling)
+        v_max = max(v for h, v in sampling)
+        for chan, (coeffs, table, (h, v)) in enumerate(zip(
+                coefficients, quant_tables, sampling)):
+            if reduction > 1:
+                # Keep the low frequencies, which hold a size x size decode
+                dequantizers = (np.asarray(table)[..., :size, :size] /
+                                _reduced_dct_scale(size))
+                with self._stage('dequantize', coeffs):
+                    scaled = (coeffs[..., :size, :size] *
+                              dequantizers.astype(self.float_dtype))
+                with self._stage('idct', scaled):
+                    if size > 1:
+                        scaled = block_idct2(scaled)
+                    blocks = scaled + 128.0
+            elif self.engine == 'fixed':
+                with self._stage('dequantize', coeffs):
+                    scaled = np.rint(coeffs * _fixed_dequantizers(table))
+                with self._stage('idct', scaled):
+                    blocks = fixed_block_idct8(scaled) + 128
+            else:
+                with self._stage('dequantize', coeffs):
+                    dequantizers = (table / DCT_SCALE).astype(
+                        self.float_dtype)
+                    scaled = coeffs * dequantizers
+                with self._stage('idct', scaled):
+                    blocks = block_idct2(scaled) + 128.0
+
+            factors = (v_max // v, h_max // h)
+            if factors == (1, 1):
+                with self._stage('reassemble', blocks):
+                    unsplit_image(blocks, out=ycbcr_image[..., chan])
+            else:
+                with self._stage('reassemble', blocks):
+                    plane = unsplit_image(blocks)
+                with self._stage('upsample', plane):
+                    ycbcr_image[..., chan] = upsample(plane, factors)
+                del plane
+            # Free the planes of this component before the next is decoded
+            del scaled, blocks
+
+        height = -(-height // reduction)
+        width = -(-width // reduction)
+        ycbcr_image = ycbcr_image[..., :height, :width, :]
+        with self._stage('ycbcr_to_rgb', ycbcr_image):
+            rgb_image = self.ycbcr_to_rgb(ycbcr_image)
 
         return rgb_image
 
-    def quantize_freqs(self, block):
-        """Quantize an block of data using the quantization matrix self.Q"""
-        return np.round(block / self.Q).astype(int)
+    def _stage(self, name, data=None):
+        """Return a context manager that records one call of a pipeline
+        stage processing data in self.stats, or a shared no-op without
+        stats"""
+        if self.stats is None:
+            return _NO_STATS
+        return self.stats.stage(name, data)
+
+    def entropy_encode(self, compressed, dc_tables=None, ac_tables=None):
+        """Huffman code a CompressedImage into a packed byte buffer
+
+        Blocks are zigzag ordered, DC and run-length coded and interleaved
+        by component, giving the entropy coded scan of a baseline JPEG.
+        dc_tables and ac_tables are per component HuffmanTables, by default
+        the standard tables."""
+        if dc_tables is None:
+            dc_tables = self.dc_tables
+        if ac_tables is None:
+            ac_tables = self.ac_tables
+
+        with self._stage('entropy_encode', compressed.coefficients):
+            zz, components = huffman.interleave(compressed.coefficients,
+                                                compressed.sampling)
+
+            writer = huffman.encode_blocks(
+                zz, components, dc_tables, ac_tables,
+                restart_interval=self._restart_blocks(compressed.sampling))
+            writer.flush()
+
+            return writer.getvalue()
+
+    def entropy_decode(self, data, height, width, dc_tables=None,
+                       ac_tables=None):
+        """Decode the output of entropy_encode for an image of the given size,
+        coded with the given (by default the standard) Huffman tables, back
+        into a CompressedImage"""
+        if dc_tables is None:
+            dc_tables = self.dc_tables
+        if ac_tables is None:
+            ac_tables = self.ac_tables
+        grids = component_grids(height, width, self.sampling)
+        components = huffman.scan_components(grids, self.sampling)
+
+        with self._stage('entropy_decode', data):
+            zz = self._decode_scan(data, components, dc_tables, ac_tables,
+                                   self._restart_blocks(self.sampling))
+            zz = zz.astype(self.coeff_dtype, copy=False)
+        coefficients = huffman.deinterleave(zz, grids, self.sampling)
+
+        return CompressedImage(coefficients, height, width, self.quant_tables,
+                               sampling=self.sampling)
+
+    def optimal_tables(self, compressed):
+        """Return the per component DC and AC HuffmanTables that code a
+        CompressedImage in the fewest bits
+
+        Components that share a standard table share an optimal table, built
+        from their combined symbol frequencies."""
+        zz, components = huffman.interleave(compressed.coefficients,
+                                            compressed.sampling)
+        return self._optimal_tables(
+            zz, components, self._restart_blocks(compressed.sampling))
+
+    def _optimal_tables(self, zz, components, restart_blocks):
+        with self._stage('entropy_optimize', zz):
+            n_components = len(self.dc_tables)
+            counts = huffman.symbol_frequencies(zz, components, n_components,
+                                                restart_blocks)
+
+            tables = []
+            for standard, comp_counts in zip((self.dc_tables, self.ac_tables),
+                                             counts):
+                ids, unique = assign_table_ids(standard)
+                ids = np.array(ids)
+                optimal = [huffman.optimal_table(comp_counts[ids == n].sum(0))
+                           for n in range(len(unique))]
+                tables.append([optimal[n] for n in ids])
+
+        return tables
+
+    def write(self, compressed, fileobj):
+        """Write a CompressedImage to a binary file-like object as a
+        baseline JFIF file"""
+        dc_tables, ac_tables = self.dc_tables, self.ac_tables
+        if self.optimize:
+            dc_tables, ac_tables = self.optimal_tables(compressed)
+
+        data = self._jfif_data(compressed.height, compressed.width,
+                               compressed.quant_tables, compressed.sampling,
+                               dc_tables, ac_tables)
+        data.scan_data = self.entropy_encode(compressed, dc_tables, ac_tables)
+        write_jfif(fileobj, data)
+
+    def write_stream(self, image, fileobj, height=None):
+        """Compress an rgb image straight to a baseline JFIF file, one row of
+        MCUs (8 or 16 pixel rows) at a time
+
+        image is an array, such as a np.memmap, or an iterable of row strips
+        of any height, in which case the image height must be given.  Coded
+        bytes are written to fileobj as they are produced, so memory use is
+        proportional to the image width (and strip height), not its area.
+        The file is identical to write(compress(image), fileobj), except
+        that the standard Huffman tables are used even with optimize, as
+        rows are coded before the rest of the image is seen."""
+        if isinstance(image, np.ndarray):
+            height = image.shape[0]
+            mcu_height = 8 * max(v for h, v in self.sampling)
+            strips = (image[start:start + mcu_height]
+                      for start in range(0, height, mcu_height))
+        elif height is None:
+            raise ValueError("height is required when image is an iterable "
+                             "of strips")
+        else:
+            strips = iter(image)
+
+        strips = self._mcu_rows(strips)
+        try:
+            first = next(strips)
+        except StopIteration:
+            raise ValueError("No image strips supplied")
+        width = first.shape[1]
+
+        write_header(fileobj, self._jfif_data(height, width, self.quant_tables,
+                                              self.sampling))
+
+        writer = huffman.BitWriter()
+        predictors = {}
+        restart_blocks = self._restart_blocks(self.sampling)
+        n_rows = 0
+        n_blocks = 0
+        for mcu_row in itertools.chain([first], strips):
+            n_rows += mcu_row.shape[0]
+            quant_blocks = self.quantized_blocks(mcu_row)
+            with self._stage('entropy_encode', quant_blocks):
+                zz, components = huffman.interleave(quant_blocks,
+                                                    self.sampling)
+                huffman.encode_blocks(zz, components, self.dc_tables,
+                                      self.ac_tables, writer, predictors,
+                                      restart_blocks, n_blocks)
+            n_blocks += len(zz)
+            fileobj.write(writer.drain())
+
+        if n_rows != height:
+            raise ValueError("Strips hold {} rows, expected {}".format(
+                n_rows, height))
+
+        writer.flush()
+        fileobj.write(writer.drain())
+        write_trailer(fileobj)
+
+    def _mcu_rows(self, strips):
+        """Regroup an iterable of row strips into rows of MCUs.  The last row
+        may be shorter."""
+        mcu_height = 8 * max(v for h, v in self.sampling)
+        pending = []
+        n_pending = 0
+        for strip in strips:
+            strip = np.asarray(strip)
+            pending.append(strip)
+            n_pending += strip.shape[0]
+            if n_pending < mcu_height:
+                continue
+
+            rows = np.concatenate(pending) if len(pending) > 1 else strip
+            n_whole = n_pending - n_pending % mcu_height
+            for start in range(0, n_whole, mcu_height):
+                yield rows[start:start + mcu_height]
+            pending = [rows[n_whole:]]
+            n_pending -= n_whole
+
+        if n_pending:
+            yield np.concatenate(pending)
+
+    def _jfif_data(self, height, width, quant_tables, sampling,
+                   dc_tables=None, ac_tables=None):
+        """Return the JfifData headers of an image coded with the given
+        Huffman tables, by default this compressor's standard tables"""
+        if dc_tables is None:
+            dc_tables = self.dc_tables
+        if ac_tables is None:
+            ac_tables = self.ac_tables
+        quant_ids, quant_tables = assign_table_ids(quant_tables)
+        dc_ids, dc_tables = assign_table_ids(dc_tables)
+        ac_ids, ac_tables = assign_table_ids(ac_tables)
+
+        components = [FrameComponent(n + 1, h, v, quant_ids[n], dc_ids[n],
+                                     ac_ids[n])
+                      for n, (h, v) in enumerate(sampling)]
+
+        return JfifData(height, width, components,
+                        dict(enumerate(quant_tables)),
+                        dict(enumerate(dc_tables)),
+                        dict(enumerate(ac_tables)),
+                        restart_interval=self.restart_interval)
+
+    def _restart_blocks(self, sampling, restart_interval=None):
+        """Return the number of blocks in a restart interval of a scan with
+        the given sampling factors, 0 without restarts"""
+        if restart_interval is None:
+            restart_interval = self.restart_interval
+        return restart_interval * sum(h * v for h, v in sampling)
+
+    def _decode_scan(self, data, components, dc_tables, ac_tables,
+                     restart_blocks):
+        """Entropy decode scan data, decoding restart intervals of
+        restart_blocks blocks in parallel when workers > 1"""
+        if not restart_blocks:
+            return huffman.decode_blocks(data, components, dc_tables,
+                                         ac_tables)
+
+        segments = huffman.split_restart_intervals(data)
+        if (self.workers > 1 and
+                len(components) * 64 >= self.PARALLEL_MIN_PIXELS):
+            return self._worker_pool().decode_intervals(
+                segments, components, dc_tables, ac_tables, restart_blocks)
+        return huffman.decode_intervals(segments, components, dc_tables,
+                                        ac_tables, restart_blocks)
+
+    def read(self, fileobj):
+        """Read a baseline JFIF file written by write (or any interleaved
+        Y'CbCr baseline JPEG) into a CompressedImage"""
+        data = read_jfif(fileobj)
+        if len(data.components) != 3:
+            raise ValueError("Only 3 component Y'CbCr images are supported")
+
+        sampling = [(comp.h_sampling, comp.v_sampling)
+                    for comp in data.components]
+        grids = component_grids(data.height, data.width, sampling)
+        components = huffman.scan_components(grids, sampling)
+
+        with self._stage('entropy_decode', data.scan_data):
+            zz = self._decode_scan(
+                data.scan_data, components,
+                [data.dc_tables[comp.dc_table] for comp in data.components],
+                [data.ac_tables[comp.ac_table] for comp in data.components],
+                self._restart_blocks(sampling, data.restart_interval))
+            zz = zz.astype(self.coeff_dtype, copy=False)
+        coefficients = huffman.deinterleave(zz, grids, sampling)
+        quant_tables = [data.quant_tables[comp.quant_table]
+                        for comp in data.components]
+
+        return CompressedImage(coefficients, data.height, data.width,
+                               quant_tables, sampling=sampling)
+
+    def quantize_freqs(self, block, component=0):
+        """Quantize an block of data using the quantization table of a
+        component, multiplying by the precomputed reciprocal of the table"""
+        quantized = np.rint(block * self._quant_reciprocals[component])
+        return quantized.astype(self.coeff_dtype)
 
     def ycbcr_to_rgb(self, ycbcr_image):
-        """Conberts Y'CBCR Image to an 8-bit RGB image"""
-        ypbpr_image = ycbcr_image / 255.0
-        ypbpr_image[:, :, 1:3] -= 0.5
+        """Conberts Y'CBCR Image to an 8-bit RGB image
 
-        rgb_prime = self.ypbpr_to_rgb(ypbpr_image)
-        return self.gamma_expand(rgb_prime)
+        The offset and scaling from 8-bit Y'CbCr are folded into a single
+        3x3 matrix product over all pixels."""
+        # rgb' = (ycbcr / 255 - [0, 0.5, 0.5]) @ M.T for M = ypbpr_to_rgb
+        matrix = (self._ypbpr_to_rgb.T / 255.0).astype(self.float_dtype)
+        offset = -0.5 * (self._ypbpr_to_rgb[:, 1] + self._ypbpr_to_rgb[:, 2])
+        offset = offset.astype(self.float_dtype)
 
-    def ypbpr_to_rgb(self, ypbpr_image):
-        """Converts a Y'PBPR image to an 8-bit RGB image"""
-        y_prime = ypbpr_image[:, :, 0]
-        c_b = ypbpr_image[:, :, 1]
-        c_r = ypbpr_image[:, :, 2]
+        rgb_prime = np.matmul(ycbcr_image, matrix)
+        rgb_prime += offset
+        np.clip(rgb_prime, 0.0, 1.0, out=rgb_prime)
 
-        r_prime = 2.0 * c_r * (1.0 - self._k_r) + y_prime
-        b_prime = 2.0 * c_b * (1.0 - self._k_b) + y_prime
-        g_prime = (y_prime - self._k_r * r_prime - self._k_b * b_prime) / self._k_g
+        return self.gamma_expand(rgb_prime, self.gamma)
 
-        ypbpr = np.stack([r_prime, g_prime, b_prime], 2)
+    def ypbpr_to_rgb(self, ypbpr_image):
+        """Converts a Y'PBPR image to an 8-bit RGB image"""
+        rgb_prime = np.matmul(ypbpr_image,
+                              self._ypbpr_to_rgb.T.astype(self.float_dtype))
 
         # Force values to inverval [0, 1]
-        ypbpr[ypbpr < 0.0] = 0.0
-        ypbpr[ypbpr > 1.0] = 1.0
+        np.clip(rgb_prime, 0.0, 1.0, out=rgb_prime)
 
-        return ypbpr
+        return rgb_prime
 
     def rgb_to_ycbcr(self, rgb_image):
         """Converts an 8-bit RGB image to a gamma corrected Y'CBCR Image
@@ -102,42 +1010,41 @@ class JpegCompressor(object):
         Input: rgb_image with 8-bit channels (0-255)
 
         Output: ycbcr_image with 8-bit channles (0-255)"""
-        ypbpr_image = self.rgb_to_ypbpr(rgb_image)
-        ypbpr_image[:, :, 1:3] += 0.5
-        ycbcr_image = ypbpr_image * 255
+        ycbcr_image = self.rgb_to_ypbpr(rgb_image, scale=255.0)
+        ycbcr_image[..., 1:3] += 127.5
+        np.rint(ycbcr_image, out=ycbcr_image)
 
         return ycbcr_image.astype('uint8')
 
-    def rgb_to_ypbpr(self, rgb_image):
-        """Converts an RGB image into a Y'PBPR image"""
-        if rgb_image.dtype == 'uint8':
-            rgb_image = self.gamma_correct(rgb_image)
-
-        r_prime = rgb_image[:, :, 0]
-        g_prime = rgb_image[:, :, 1]
-        b_prime = rgb_image[:, :, 2]
+    def rgb_to_ypbpr(self, rgb_image, scale=1.0):
+        """Converts an RGB image into a Y'PBPR image
 
-        # TODO: Implement this as a matrix operation
-        y_prime = self._k_r * r_prime + self._k_g * g_prime + self._k_b * b_prime
-        c_b = 0.5 * (b_prime - y_prime) / (1.0 - self._k_b)
-        c_r = 0.5 * (r_prime - y_prime) / (1.0 - self._k_r)
-
-        component_list = [y_prime, c_b, c_r]
-
-        ycbcr = np.stack(component_list, 2)
+        8-bit input is gamma corrected through a lookup table.  The color
+        transform, and an optional output scale, is a single 3x3 matrix
+        product over all pixels."""
+        rgb_image = np.asarray(rgb_image)
+        if rgb_image.dtype == 'uint8':
+            rgb_image = self.gamma_correct(rgb_image, self.gamma,
+                                           self.float_dtype)
 
-        return ycbcr
+        matrix = (self._rgb_to_ypbpr.T * scale).astype(self.float_dtype)
+        return np.matmul(rgb_image, matrix)
 
     @staticmethod
-    def gamma_correct(rgb_image, gamma=0.45):
+    def gamma_correct(rgb_image, gamma=0.45, dtype=np.float64):
         """Apply gamma correction and scale values to range 0 to 1
 
         Input: rgb_image with 8-bit channels (0-255)
 
         Output: gamma corrected rgb image with floating point values (0-1)
+        of the given dtype
+
+        uint8 arrays are corrected through a 256 entry lookup table.
         """
+        if getattr(rgb_image, 'dtype', None) == np.uint8:
+            return _gamma_table(gamma, np.dtype(dtype))[rgb_image]
 
-        rgb_prime = rgb_image / 255.0
+        rgb_prime = np.true_divide(rgb_image, 255, dtype=dtype)
         return rgb_prime**gamma
 
     @staticmethod
@@ -149,4 +1056,4 @@ class JpegCompressor(object):
         Output: RGB image with 8-bit pixel values
         """
         rgb_image = rgb_prime**(1 / gamma) * 255.0
-        return rgb_image.astype('uint8')
+        return np.round(rgb_image).astype('uint8')
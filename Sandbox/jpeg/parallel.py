@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+
+import numpy as np
+
+from Sandbox.jpeg import huffman
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8: process workers are sent pixels and return coefficients
+    shared_memory = None
+
+"""
+Parallel band encoding and restart interval decoding
+
+The image is split into horizontal bands aligned to the MCU height and each
+band is color converted, transformed and quantized by a pool worker.  Blocks
+never straddle a band, so the result is identical to encoding the whole
+image at once.
+
+A WorkerPool keeps its workers between calls.  Process workers read the
+image from, and write their coefficients straight into, shared memory, so
+no pixel or coefficient data is pickled: the returned coefficient arrays
+are the ones the workers wrote.  Images that are not already in shared
+memory (see WorkerPool.shared_array) are copied into a staging buffer that
+is reused between calls.  Without multiprocessing.shared_memory (Python
+< 3.8) bands and their coefficients are pickled instead.  Stages recorded
+by process workers are sent back and added to the compressor's stats.
+
+Scans with restart markers are entropy decoded by splitting the scan data
+at the markers and decoding contiguous runs of intervals in pool workers.
+"""
+
+
+def band_slices(n_mcu_rows, band_mcu_rows):
+    """Return (start, stop) MCU rows of each band"""
+    return [(start, min(start + band_mcu_rows, n_mcu_rows))
+            for start in range(0, n_mcu_rows, band_mcu_rows)]
+
+
+class SharedBuffer(object):
+    """A block of shared memory that process pool workers attach to by name
+
+    np.asarray(buffer) is a uint8 array of the whole block.  Arrays made
+    from it keep the block mapped, and the block is unlinked once none is
+    left, or earlier by unlink."""
+    def __init__(self, size):
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=max(size, 1))
+        self.name = self._shm.name
+        self.size = size
+        self.linked = True
+
+        # Arrays refer to the block through __array_interface__ rather than
+        # a buffer export, which would stop it from being closed
+        view = np.frombuffer(self._shm.buf, dtype=np.uint8)
+        self.address = view.__array_interface__['data'][0]
+        del view
+
+    @property
+    def __array_interface__(self):
+        return {'shape': (self.size,), 'typestr': '|u1',
+                'data': (self.address, False), 'version': 3}
+
+    def array(self, shape, dtype):
+        """Return an array of the given shape and dtype at the start of the
+        block"""
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        return np.asarray(self)[:n_bytes].view(dtype).reshape(shape)
+
+    def unlink(self):
+        """Remove the name of the block.  Its arrays remain valid."""
+        if self.linked:
+            self.linked = False
+            self._shm.unlink()
+
+    def __del__(self):
+        if getattr(self, 'linked', False):
+            self.unlink()
+
+
+def _shared_buffer(array):
+    """Return the linked SharedBuffer a C contiguous array lies in, or None"""
+    base = array
+    while isinstance(base, np.ndarray):
+        base = base.base
+    if (isinstance(base, SharedBuffer) and base.linked and
+            array.flags.c_contiguous):
+        return base
+    return None
+
+
+def _shared_spec(array):
+    """Return the spec workers attach to an array in a SharedBuffer with"""
+    buffer = _shared_buffer(array)
+    offset = array.__array_interface__['data'][0] - buffer.address
+    return buffer.name, offset, array.shape, array.dtype.str
+
+
+def _attach(spec):
+    """Attach to an array in shared memory"""
+    name, offset, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+
+
+def _encode_band(compressor, image, outputs, mcu_start, mcu_stop):
+    """Encode MCU rows mcu_start to mcu_stop of image into outputs"""
+    mcu_height = 8 * max(v for h, v in compressor.sampling)
+    band = image[mcu_start * mcu_height:mcu_stop * mcu_height]
+
+    coefficients = compressor.quantized_blocks(band)
+    for out, coeffs, (h, v) in zip(outputs, coefficients,
+                                   compressor.sampling):
+        out[mcu_start * v:mcu_stop * v] = coeffs
+
+
+def _record_calls(compressor):
+    """Return a list that collects the stage calls recorded by a process
+    worker's copy of the compressor, as (name, seconds, nbytes,
+    peak_memory)"""
+    calls = []
+    if compressor.stats is not None:
+        compressor.stats.hooks.append(lambda *call: calls.append(call))
+    return calls
+
+
+def _add_calls(compressor, calls):
+    """Add stage calls recorded by a process worker to the stats"""
+    for call in calls:
+        compressor.stats.record(*call)
+
+
+def _quantize_band(compressor, band):
+    """Process pool entry point: return the quantized blocks of a band and
+    the stage calls recorded"""
+    calls = _record_calls(compressor)
+    return compressor.quantized_blocks(band), calls
+
+
+def _encode_band_shared(compressor, image_spec, output_specs, mcu_start,
+                        mcu_stop):
+    """Process pool entry point: encode a band held in shared memory and
+    return the stage calls recorded"""
+    calls = _record_calls(compressor)
+    shms = []
+    arrays = []
+    array = None
+    try:
+        for spec in [image_spec] + output_specs:
+            shm, array = _attach(spec)
+            shms.append(shm)
+            arrays.append(array)
+        _encode_band(compressor, arrays[0], arrays[1:], mcu_start, mcu_stop)
+    finally:
+        # Views must be released before the shared memory can be closed
+        del array, arrays[:]
+        for shm in shms:
+            shm.close()
+    return calls
+
+
+class WorkerPool(object):
+    """A pool of 'process' or 'thread' workers that is started on first use
+    and kept until close"""
+    def __init__(self, workers, pool='process'):
+        if pool not in ('process', 'thread'):
+            raise ValueError("Unsupported pool. Only 'process' or 'thread' "
+                             "is valid")
+        self.workers = workers
+        self.pool = pool
+        self._executor = None
+        self._staging = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.pool == 'thread':
+                executor_type = concurrent.futures.ThreadPoolExecutor
+            else:
+                executor_type = concurrent.futures.ProcessPoolExecutor
+            self._executor = executor_type(self.workers)
+        return self._executor
+
+    def close(self):
+        """Shut the workers down and release the staging buffer"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._staging = None
+
+    def __del__(self):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+
+    def shared_array(self, shape, dtype):
+        """Return a new array that workers read and write in place, in
+        shared memory for a process pool"""
+        if self.pool == 'thread' or shared_memory is None:
+            return np.empty(shape, dtype=dtype)
+        dtype = np.dtype(dtype)
+        buffer = SharedBuffer(int(np.prod(shape)) * dtype.itemsize)
+        return buffer.array(shape, dtype)
+
+    def _image_spec(self, image):
+        """Return the spec of image in shared memory, copying it to the
+        staging buffer if it is not there already"""
+        if _shared_buffer(image) is not None:
+            return _shared_spec(image)
+
+        if self._staging is None or self._staging.size < image.nbytes:
+            self._staging = SharedBuffer(image.nbytes)
+        staged = self._staging.array(image.shape, image.dtype)
+        staged[...] = image
+        return _shared_spec(staged)
+
+    def encode_bands(self, compressor, rgb_image, grids, band_mcu_rows):
+        """Encode rgb_image band by band
+
+        grids gives the (rows, cols) of blocks of each component.  Returns
+        the (rows, cols, 8, 8) coefficient array of each component.  Stages
+        run by process workers are added to compressor.stats."""
+        outputs = [self.shared_array((rows, cols, 8, 8),
+                                     compressor.coeff_dtype)
+                   for rows, cols in grids]
+        n_mcu_rows = grids[0][0] // compressor.sampling[0][1]
+        bands = band_slices(n_mcu_rows, band_mcu_rows)
+        executor = self._get_executor()
+
+        if self.pool == 'thread':
+            futures = [executor.submit(_encode_band, compressor, rgb_image,
+                                       outputs, start, stop)
+                       for start, stop in bands]
+        elif shared_memory is None:
+            mcu_height = 8 * max(v for h, v in compressor.sampling)
+            results = [executor.submit(_quantize_band, compressor,
+                                       rgb_image[start * mcu_height:
+                                                 stop * mcu_height])
+                       for start, stop in bands]
+            for (start, stop), result in zip(bands, results):
+                coefficients, calls = result.result()
+                for out, coeffs, (h, v) in zip(outputs, coefficients,
+                                               compressor.sampling):
+                    out[start * v:stop * v] = coeffs
+                _add_calls(compressor, calls)
+            futures = []
+        else:
+            image_spec = self._image_spec(rgb_image)
+            output_specs = [_shared_spec(out) for out in outputs]
+            futures = [executor.submit(_encode_band_shared, compressor,
+                                       image_spec, output_specs, start, stop)
+                       for start, stop in bands]
+        for future in futures:
+            calls = future.result()
+            if calls is not None:
+                _add_calls(compressor, calls)
+
+        # Workers are done with the outputs, which stay mapped in this
+        # process for as long as they are used
+        for out in outputs:
+            buffer = _shared_buffer(out)
+            if buffer is not None:
+                buffer.unlink()
+
+        return outputs
+
+    def decode_intervals(self, segments, components, dc_tables, ac_tables,
+                         restart_interval):
+        """Decode restart intervals, as returned by
+        huffman.split_restart_intervals
+
+        Each worker decodes a contiguous run of intervals, see
+        huffman.decode_intervals.  Returns the (n_blocks, 64) zigzag ordered
+        blocks of the whole scan.  Thread workers read the segments in
+        place, while process workers are sent copies."""
+        components = np.asarray(components)
+        n_intervals = -(-components.size // restart_interval)
+        if len(segments) != n_intervals:
+            raise ValueError("Scan has {} restart intervals, expected "
+                             "{}".format(len(segments), n_intervals))
+
+        runs = band_slices(n_intervals,
+                           max(-(-n_intervals // self.workers), 1))
+        if self.pool == 'process':
+            # memoryviews cannot be pickled
+            segments = [bytes(segment) for segment in segments]
+        executor = self._get_executor()
+        futures = [executor.submit(huffman.decode_intervals,
+                                   segments[start:stop],
+                                   components[start * restart_interval:
+                                              stop * restart_interval],
+                                   dc_tables, ac_tables, restart_interval)
+                   for start, stop in runs]
+
+        return np.concatenate([future.result() for future in futures])
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import tracemalloc
+
+"""
+Per-stage instrumentation of the JPEG pipeline
+
+A PipelineStats passed to JpegCompressor(stats=...) accumulates the wall
+time, bytes processed and, optionally, the peak memory allocated by each
+stage of compress and decompress, and calls any hooks as each stage ends so
+the numbers can be exported to a metrics system.  Compressors without stats
+skip all of this.
+"""
+
+
+def _reset_peak():
+    """Start a new tracemalloc peak.  Python < 3.9 has no reset_peak, so
+    the traces are cleared instead, which also stops tracking earlier
+    allocations."""
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.clear_traces()
+
+
+class StageStats(object):
+    """Accumulated measurements of one pipeline stage
+
+    bytes is the size of the stage's input arrays and peak_memory the
+    largest peak allocation of a single call, in bytes, when memory tracing
+    is enabled."""
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.peak_memory = 0
+
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds,
+                'bytes': self.bytes, 'peak_memory': self.peak_memory}
+
+
+def _nbytes(data):
+    """Total size of an array, a bytes object or a list of arrays"""
+    if isinstance(data, (list, tuple)):
+        return sum(_nbytes(item) for item in data)
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    return getattr(data, 'nbytes', 0)
+
+
+class _Stage(object):
+    """Context manager that times one call of a stage"""
+    def __init__(self, stats, name, nbytes):
+        self._stats = stats
+        self._name = name
+        self._nbytes = nbytes
+
+    def __enter__(self):
+        if self._stats.trace_memory:
+            _reset_peak()
+            self._start_memory = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        peak_memory = 0
+        if self._stats.trace_memory:
+            peak_memory = (tracemalloc.get_traced_memory()[1] -
+                           self._start_memory)
+        self._stats.record(self._name, seconds, self._nbytes, peak_memory)
+
+
+class PipelineStats(object):
+    """Per-stage wall time, bytes processed and peak memory of a pipeline
+
+    hooks are callables called as hook(stage, seconds, nbytes, peak_memory)
+    after every call of a stage.  trace_memory records the peak memory
+    allocated by each stage through tracemalloc, which is started if needed.
+    Tracing slows the pipeline down, so it is off by default.
+
+    Stats may be shared between threads.  Process pool workers record
+    stages in a copy of the stats, without memory tracing, and the calls
+    are added here, and passed to the hooks, as the workers finish."""
+    def __init__(self, hooks=None, trace_memory=False):
+        self.hooks = list(hooks) if hooks is not None else []
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._lock = threading.Lock()
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __getstate__(self):
+        # Workers get an empty copy without the (possibly unpicklable) hooks,
+        # see Sandbox.jpeg.parallel
+        return {'trace_memory': False}
+
+    def __setstate__(self, state):
+        self.__init__(trace_memory=state['trace_memory'])
+
+    def stage(self, name, data=None):
+        """Return a context manager that records one call of stage name,
+        processing data (an array, bytes or a list of arrays)"""
+        return _Stage(self, name, _nbytes(data))
+
+    def record(self, name, seconds, nbytes=0, peak_memory=0):
+        """Add one call of a stage and pass it to the hooks"""
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageStats()
+            stage.calls += 1
+            stage.seconds += seconds
+            stage.bytes += nbytes
+            stage.peak_memory = max(stage.peak_memory, peak_memory)
+
+        for hook in self.hooks:
+            hook(name, seconds, nbytes, peak_memory)
+
+    def reset(self):
+        """Discard all recorded measurements"""
+        with self._lock:
+            self.stages = {}
+
+    def as_dict(self):
+        """Return the measurements of every stage as plain dicts"""
+        with self._lock:
+            return {name: stage.as_dict()
+                    for name, stage in self.stages.items()}
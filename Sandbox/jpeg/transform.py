@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from Sandbox.jpeg.jpeg import CompressedImage
+
+"""
+Lossless transforms of compressed images
+
+Flips, transposes, rotations by multiples of 90 degrees and crops are done
+directly on the quantized DCT coefficients, without an inverse or forward
+transform, so they are exact and cost little more than copying the
+coefficients.  Mirroring a block reverses the sign of its odd frequencies
+along the mirrored axis, and transposing a block transposes its
+coefficients (and quantization table).
+
+Images padded out to a whole number of MCUs keep their padding on the
+bottom and right edges, so flips, and rotations that move the right or
+bottom edge, trim any partial MCU on that edge first, as jpegtran -trim
+does.
+"""
+
+
+def _mcu_shape(compressed):
+    """Return the (height, width) of an MCU in pixels"""
+    h_max = max(h for h, v in compressed.sampling)
+    v_max = max(v for h, v in compressed.sampling)
+    return 8 * v_max, 8 * h_max
+
+
+def _replace(compressed, coefficients, height, width, quant_tables=None,
+             sampling=None):
+    """Return a CompressedImage like compressed with new coefficients and
+    geometry"""
+    if quant_tables is None:
+        quant_tables = compressed.quant_tables
+    if sampling is None:
+        sampling = compressed.sampling
+    return CompressedImage(coefficients, height, width, quant_tables,
+                           compressed.block_shape, sampling)
+
+
+def _trimmed(size, mcu_size):
+    """Return size rounded down to whole MCUs"""
+    trimmed = size - size % mcu_size
+    if not trimmed:
+        raise ValueError("Image is smaller than one MCU")
+    return trimmed
+
+
+def flip_horizontal(compressed):
+    """Mirror a CompressedImage left to right"""
+    mcu_height, mcu_width = _mcu_shape(compressed)
+    width = _trimmed(compressed.width, mcu_width)
+
+    coefficients = []
+    for coeffs, (h, v) in zip(compressed.coefficients, compressed.sampling):
+        flipped = coeffs[:, width // mcu_width * h - 1::-1].copy()
+        flipped[..., 1::2] *= -1
+        coefficients.append(flipped)
+
+    return _replace(compressed, coefficients, compressed.height, width)
+
+
+def flip_vertical(compressed):
+    """Mirror a CompressedImage top to bottom"""
+    mcu_height, mcu_width = _mcu_shape(compressed)
+    height = _trimmed(compressed.height, mcu_height)
+
+    coefficients = []
+    for coeffs, (h, v) in zip(compressed.coefficients, compressed.sampling):
+        flipped = coeffs[height // mcu_height * v - 1::-1].copy()
+        flipped[..., 1::2, :] *= -1
+        coefficients.append(flipped)
+
+    return _replace(compressed, coefficients, height, compressed.width)
+
+
+def transpose(compressed):
+    """Transpose a CompressedImage across its main diagonal
+
+    The sampling factors and quantization tables of each component are
+    transposed too."""
+    coefficients = [np.ascontiguousarray(coeffs.transpose(1, 0, 3, 2))
+                    for coeffs in compressed.coefficients]
+    quant_tables = [np.asarray(table).T.copy()
+                    for table in compressed.quant_tables]
+    sampling = [(v, h) for h, v in compressed.sampling]
+
+    return _replace(compressed, coefficients, compressed.width,
+                    compressed.height, quant_tables, sampling)
+
+
+def rotate(compressed, angle):
+    """Rotate a CompressedImage clockwise by 90, 180 or 270 degrees"""
+    if angle == 90:
+        return flip_horizontal(transpose(compressed))
+    if angle == 180:
+        return flip_vertical(flip_horizontal(compressed))
+    if angle == 270:
+        return flip_vertical(transpose(compressed))
+    raise ValueError("Unsupported angle. Only 90, 180 or 270 is valid")
+
+
+def crop(compressed, top, left, height, width):
+    """Crop the height x width pixel rectangle at (top, left) out of a
+    CompressedImage
+
+    top and left must be multiples of the MCU size, 8 or 16 pixels.  The
+    rectangle is clipped to the image."""
+    mcu_height, mcu_width = _mcu_shape(compressed)
+    if top % mcu_height or left % mcu_width:
+        raise ValueError("Crop offset must be a multiple of the {}x{} MCU "
+                         "size".format(mcu_height, mcu_width))
+
+    height = min(height, compressed.height - top)
+    width = min(width, compressed.width - left)
+    if top < 0 or left < 0 or height <= 0 or width <= 0:
+        raise ValueError("Crop does not intersect the image")
+
+    row0, col0 = top // mcu_height, left // mcu_width
+    row1 = row0 + -(-height // mcu_height)
+    col1 = col0 + -(-width // mcu_width)
+
+    coefficients = [coeffs[row0 * v:row1 * v, col0 * h:col1 * h].copy()
+                    for coeffs, (h, v) in zip(compressed.coefficients,
+                                              compressed.sampling)]
+
+    return _replace(compressed, coefficients, height, width)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from Sandbox.benchmarks import benchmarks
+from Sandbox.benchmarks.benchmarks import (run, compare, confirm,
+                                           machine_differences,
+                                           synthetic_image)
+from Sandbox.jpeg.jpeg import JpegCompressor
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        # Keep the benchmark runs in the tests short
+        self.min_time = benchmarks.MIN_TIME
+        self.min_repeats = benchmarks.MIN_REPEATS
+        benchmarks.MIN_TIME = 0
+        benchmarks.MIN_REPEATS = 1
+
+    def tearDown(self):
+        benchmarks.MIN_TIME = self.min_time
+        benchmarks.MIN_REPEATS = self.min_repeats
+
+    def test_synthetic_image(self):
+        image = synthetic_image(30, 20)
+        self.assertEqual(image.shape, (30, 20, 3))
+        self.assertEqual(image.dtype.name, 'uint8')
+        self.assertTrue((synthetic_image(30, 20) == image).all())
+
+    def test_run(self):
+        """Test that every workload reports throughput and memory"""
+        log = io.StringIO()
+        with mock.patch.object(JpegCompressor, 'PARALLEL_MIN_PIXELS', 0):
+            results = run(['64x64'], workers=2, log=log)
+
+        names = {(result['workload'], result['mode']) for result in results}
+        self.assertIn(('compress', 'serial'), names)
+        self.assertIn(('compress', 'parallel'), names)
+        self.assertIn(('unsplit_image', 'serial'), names)
+        for result in results:
+            self.assertGreater(result['megapixels_per_second'], 0)
+            self.assertGreater(result['peak_memory_mb'], 0)
+            self.assertGreaterEqual(result['median_seconds'],
+                                    result['seconds'])
+        self.assertEqual(len(log.getvalue().splitlines()), len(results))
+
+    def test_run_small_parallel(self):
+        """Test that images coded serially have no parallel workloads"""
+        results = run(['64x64'], workloads=['compress'], workers=2)
+        self.assertEqual([result['mode'] for result in results], ['serial'])
+
+    def test_compare(self):
+        """Test that only slowdowns beyond the tolerance are flagged"""
+        def result(workload, mps):
+            return {'workload': workload, 'mode': 'serial', 'size': '4K',
+                    'megapixels_per_second': mps}
+
+        baseline = [result('dct2', 10.0), result('compress', 10.0)]
+        results = [result('dct2', 8.0), result('compress', 7.0),
+                   result('decompress', 1.0)]
+
+        regressions = compare(results, baseline, tolerance=0.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertEqual(regressions[0][0]['workload'], 'compress')
+        self.assertAlmostEqual(regressions[0][2], 0.7)
+
+        # Parallel workloads are skipped on a machine with other CPUs
+        base = dict(result('compress', 10.0), mode='parallel')
+        slow = dict(base, megapixels_per_second=7.0)
+        self.assertEqual(len(compare([slow], [base])), 1)
+        self.assertEqual(compare([slow], [base], parallel=False), [])
+
+    def test_confirm(self):
+        """Test that only regressions that persist when timed again are
+        reported"""
+        result, = run(['64x64'], ['block_dct2'])
+        mps = result['megapixels_per_second']
+        slow = dict(result, megapixels_per_second=mps / 100)
+
+        # A slow run on a noisy machine, against a baseline it matches
+        noise = [(slow, result, 0.01)]
+        self.assertEqual(confirm(noise, tolerance=0.9), [])
+
+        # A baseline far faster than this machine
+        base = dict(result, megapixels_per_second=mps * 100)
+        regressions = confirm([(slow, base, 0.0001)], runs=1)
+        self.assertEqual(len(regressions), 1)
+        self.assertLess(regressions[0][2], 0.75)
+
+    def test_machine_differences(self):
+        machine = benchmarks.machine_info()
+        self.assertEqual(machine_differences(machine, machine), [])
+        other = dict(machine, cpu_count=machine['cpu_count'] + 1,
+                     platform='other')
+        self.assertEqual(machine_differences(machine, other), ['cpu_count'])
+
+    def test_main(self):
+        """Test the JSON report and the baseline exit status"""
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            args = ['--sizes', '64x64', '--workloads', 'block_dct2',
+                    '--output', output]
+            self.assertEqual(benchmarks.main(args), 0)
+
+            with open(output) as f:
+                report = json.load(f)
+            self.assertIn('machine', report)
+            self.assertEqual(len(report['results']), 1)
+
+            # A baseline far faster than this machine is a regression
+            report['results'][0]['megapixels_per_second'] *= 100
+            baseline = os.path.join(tmp, 'baseline.json')
+            with open(baseline, 'w') as f:
+                json.dump(report, f)
+            self.assertEqual(benchmarks.main(args + ['--baseline', baseline]),
+                             1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
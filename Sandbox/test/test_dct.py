@@ -5,7 +5,13 @@ import numpy as np
 import scipy.fftpack
 
 from numpy.testing import assert_allclose
-from Sandbox.utils.dct import dct, idct, dct2, idct2
+from Sandbox.utils.dct import (dct, idct, dct2, idct2, block_dct2,
+                               block_idct2, dct_basis, basis_cache_info,
+                               clear_basis_cache, BASIS_CACHE_SIZE, dct_fft,
+                               idct_fft, FFT_THRESHOLD, fixed_block_dct8,
+                               fixed_block_idct8, AAN_SCALE, AAN_FDCT_BITS,
+                               AAN_IDCT_BITS)
+from Sandbox.utils import dct as dct_module
 
 
 class TestDCT(unittest.TestCase):
@@ -156,5 +162,169 @@ class TEST2DDCT(unittest.TestCase):
             assert_allclose(z, x, atol=1e-10, err_msg="Failed Test " + str(n))
 
 
+class TestBlockDCT(unittest.TestCase):
+    """Test the batched block DCT functions"""
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.blocks = rng.uniform(0, 255, (3, 5, 8, 8))
+
+    def test_block_dct2(self):
+        """Test that block_dct2 matches dct2 applied to each block"""
+        y = block_dct2(self.blocks)
+        self.assertEqual(y.shape, self.blocks.shape)
+        for index in np.ndindex(self.blocks.shape[:-2]):
+            assert_allclose(y[index], dct2(self.blocks[index]), atol=1e-10)
+
+    def test_block_idct2(self):
+        """Test that block_idct2 matches idct2 applied to each block"""
+        y = block_idct2(self.blocks)
+        for index in np.ndindex(self.blocks.shape[:-2]):
+            assert_allclose(y[index], idct2(self.blocks[index]), atol=1e-10)
+
+    def test_block_inverse(self):
+        """Test that block_idct2 inverts block_dct2 for non-square blocks"""
+        x = self.blocks[..., :4]
+        z = block_idct2(block_dct2(x))
+        assert_allclose(z, x, atol=1e-10)
+
+
+class TestFFTDCT(unittest.TestCase):
+    """Test the FFT based DCT kernels"""
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_dct_fft(self):
+        """Test that dct_fft matches the matrix DCT for even and odd N"""
+        for N in [1, 2, 3, 7, 8, 9, 16]:
+            x = self.rng.uniform(-1, 1, (N, 5))
+            assert_allclose(dct_fft(x, axis=0), dct(x, axis=0), atol=1e-10)
+            assert_allclose(dct_fft(x.T, axis=1), dct(x.T, axis=1),
+                            atol=1e-10)
+
+    def test_idct_fft(self):
+        """Test that idct_fft matches the matrix IDCT and inverts dct_fft"""
+        for N in [1, 2, 3, 7, 8, 9, 16]:
+            x = self.rng.uniform(-1, 1, (N, 5))
+            assert_allclose(idct_fft(x, axis=0), idct(x, axis=0), atol=1e-10)
+            assert_allclose(idct_fft(dct_fft(x)), x, atol=1e-10)
+
+    def test_large_dispatch(self):
+        """Test that large transforms still match scipy after dispatch"""
+        N = FFT_THRESHOLD * 2
+        x = self.rng.uniform(-1, 1, N)
+        y = dct(x)
+        assert_allclose(y, scipy.fftpack.dct(x) / 2.0, atol=1e-8)
+        assert_allclose(idct(y), x, atol=1e-10)
+
+        x = self.rng.uniform(-1, 1, (2, N))
+        y = block_dct2(x)
+        assert_allclose(y, scipy.fftpack.dctn(x) / 4.0, atol=1e-8)
+        assert_allclose(block_idct2(y), x, atol=1e-10)
+
+
+class TestBasisCache(unittest.TestCase):
+    """Test the DCT basis matrix cache"""
+    def setUp(self):
+        clear_basis_cache()
+
+    def test_basis_reused(self):
+        """Test that repeated transforms reuse the cached basis"""
+        x = np.ones((8, 8))
+        dct2(x)
+        misses = basis_cache_info().misses
+        dct2(x)
+        idct2(x)
+        idct2(x)
+        info = basis_cache_info()
+        self.assertEqual(info.misses, misses + 1)
+        self.assertGreater(info.hits, 0)
+
+    def test_basis_keys(self):
+        """Test that the cache is keyed by size, dtype and direction"""
+        forward = dct_basis(8)
+        self.assertIs(dct_basis(8, np.float64, 'forward'), forward)
+        self.assertIsNot(dct_basis(8, direction='inverse'), forward)
+        self.assertIsNot(dct_basis(4), forward)
+        self.assertEqual(dct_basis(8, np.float32).dtype, np.float32)
+        self.assertFalse(forward.flags.writeable)
+
+        with self.assertRaises(ValueError):
+            dct_basis(8, direction='sideways')
+
+    def test_cache_bounded(self):
+        """Test that unusual sizes are evicted and the cache can be cleared"""
+        for N in range(1, BASIS_CACHE_SIZE + 10):
+            dct_basis(N)
+        self.assertEqual(basis_cache_info().currsize, BASIS_CACHE_SIZE)
+
+        clear_basis_cache()
+        self.assertEqual(basis_cache_info().currsize, 0)
+
+
+class TestFixedDCT(unittest.TestCase):
+    """Test the fixed-point AAN transforms against the float transforms"""
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Random samples plus extreme +/- full scale patterns, including the
+        # signs of every 2d cosine, which give the largest forward errors
+        cosines = np.cos((2 * np.arange(8) + 1) * np.arange(8)[:, None] *
+                         np.pi / 16)
+        signs = np.einsum('ui,vj->uvij', cosines, cosines).reshape(64, 8, 8)
+        self.samples = np.concatenate((
+            rng.randint(-128, 128, (500, 8, 8)),
+            np.where(rng.uniform(size=(500, 8, 8)) < 0.5, -128, 127),
+            np.full((1, 8, 8), -128), np.full((1, 8, 8), 127),
+            np.where(signs >= 0, 127, -128), np.where(signs >= 0, -128, 127)))
+        self.scale = np.outer(AAN_SCALE, AAN_SCALE)
+
+    def test_fixed_dct(self):
+        """Test the documented forward error bound"""
+        expected = block_dct2(self.samples) * self.scale * 2**AAN_FDCT_BITS
+        result = fixed_block_dct8(self.samples + 128, offset=128)
+
+        self.assertEqual(result.dtype, np.int32)
+        error = np.max(np.abs(result - expected))
+        self.assertLess(error, 2**(AAN_FDCT_BITS + 1))
+        # The cosine sign patterns reach past the old 2**AAN_FDCT_BITS bound
+        self.assertGreater(error, 2**AAN_FDCT_BITS)
+
+    def test_fixed_idct(self):
+        """Test the documented inverse error bound"""
+        coeffs = np.rint(block_dct2(self.samples) * self.scale *
+                         2**AAN_IDCT_BITS / 64)
+        expected = block_idct2(coeffs / self.scale / 2**AAN_IDCT_BITS * 64)
+
+        result = fixed_block_idct8(coeffs.astype(np.int32))
+        self.assertEqual(result.dtype, np.int32)
+        self.assertLessEqual(np.max(np.abs(result - np.rint(expected))), 1)
+
+    def test_multipliers(self):
+        """Test scaling and rounding the forward result"""
+        multipliers = 1.0 / (self.scale * 2**AAN_FDCT_BITS)
+        result = fixed_block_dct8(self.samples, multipliers=multipliers)
+
+        # The forward error bound, unscaled, plus rounding
+        error = np.abs(result - block_dct2(self.samples))
+        self.assertTrue(np.all(error <= 2 / self.scale + 0.5))
+
+        compact = fixed_block_dct8(self.samples, multipliers=multipliers,
+                                   dtype=np.int16)
+        self.assertEqual(compact.dtype, np.int16)
+        assert_allclose(compact, result)
+
+    def test_chunks(self):
+        """Test that chunking and stacked blocks do not change the result"""
+        samples = self.samples[:998].reshape((2, 499, 8, 8))
+        expected = fixed_block_dct8(samples)
+        self.assertEqual(expected.shape, samples.shape)
+
+        chunk_blocks = dct_module.AAN_CHUNK_BLOCKS
+        try:
+            dct_module.AAN_CHUNK_BLOCKS = 7
+            assert_allclose(fixed_block_dct8(samples), expected)
+        finally:
+            dct_module.AAN_CHUNK_BLOCKS = chunk_blocks
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from Sandbox.jpeg import huffman
+from Sandbox.jpeg.huffman import (BitWriter, BitReader, HuffmanTable,
+                                  zigzag, unzigzag,
+                                  scan_symbols, encode_blocks, decode_blocks,
+                                  decode_intervals, split_restart_intervals,
+                                  scan_bits, symbol_frequencies,
+                                  optimal_table,
+                                  interleave, deinterleave)
+
+
+class TestZigzag(unittest.TestCase):
+    def test_zigzag_order(self):
+        """Test the start and end of the zigzag scan"""
+        assert_array_equal(huffman.ZIGZAG[:10],
+                           [0, 1, 8, 16, 9, 2, 3, 10, 17, 24])
+        assert_array_equal(huffman.ZIGZAG[-4:], [47, 55, 62, 63])
+        assert_array_equal(np.sort(huffman.ZIGZAG), np.arange(64))
+
+    def test_zigzag_inverse(self):
+        """Test that unzigzag inverts zigzag for stacked blocks"""
+        blocks = np.arange(3 * 64).reshape((3, 8, 8))
+        zz = zigzag(blocks)
+        self.assertEqual(zz.shape, (3, 64))
+        assert_array_equal(unzigzag(zz), blocks)
+
+    def test_interleave(self):
+        """Test MCU ordering of subsampled components"""
+        luma = np.arange(4 * 6).reshape((4, 6, 1, 1)) * np.ones((8, 8))
+        chroma = -np.arange(2 * 3).reshape((2, 3, 1, 1)) * np.ones((8, 8))
+        sampling = [(2, 2), (1, 1), (1, 1)]
+
+        zz, components = interleave([luma, chroma, chroma - 100], sampling)
+        self.assertEqual(zz.shape, (36, 64))
+        assert_array_equal(components[:12], [0, 0, 0, 0, 1, 2] * 2)
+
+        # First MCU covers luma blocks (0, 0), (0, 1), (1, 0), (1, 1)
+        assert_array_equal(zz[:6, 0], [0, 1, 6, 7, 0, -100])
+        assert_array_equal(zz[6:12, 0], [2, 3, 8, 9, -1, -101])
+
+        coefficients = deinterleave(zz, [(4, 6), (2, 3), (2, 3)], sampling)
+        assert_array_equal(coefficients[0], luma)
+        assert_array_equal(coefficients[1], chroma)
+        assert_array_equal(coefficients[2], chroma - 100)
+
+
+class TestHuffmanTable(unittest.TestCase):
+    def test_standard_codes(self):
+        """Test codes of the standard luminance tables (JPEG Annex K.3)"""
+        table = huffman.DC_LUMINANCE
+        self.assertEqual((table.codes[0], table.code_lengths[0]), (0b00, 2))
+        self.assertEqual((table.codes[1], table.code_lengths[1]), (0b010, 3))
+        self.assertEqual((table.codes[11], table.code_lengths[11]),
+                         (0b111111110, 9))
+
+        table = huffman.AC_LUMINANCE
+        self.assertEqual((table.codes[0x00], table.code_lengths[0x00]),
+                         (0b1010, 4))
+        self.assertEqual((table.codes[0xF0], table.code_lengths[0xF0]),
+                         (0b11111111001, 11))
+
+    def test_decode(self):
+        """Test decoding every symbol of the standard tables, both with the
+        lookup tables and with the fallback for long codes"""
+        for dc_table, ac_table in [(huffman.DC_LUMINANCE,
+                                    huffman.AC_LUMINANCE),
+                                   (huffman.DC_CHROMINANCE,
+                                    huffman.AC_CHROMINANCE)]:
+            # One block per AC symbol, with both signs of its extra bits
+            blocks = []
+            for symbol in ac_table.values.tolist():
+                run, size = symbol >> 4, symbol & 15
+                for sign in (1, -1):
+                    block = np.zeros(64, dtype=np.int64)
+                    if size:
+                        block[1 + run] = sign * (1 << (size - 1))
+                    elif symbol == huffman.ZRL:
+                        block[17] = sign
+                    blocks.append(block)
+            zz = np.array(blocks)
+
+            # DC differences of every size from 0 to 11
+            sizes = np.arange(len(zz)) % (huffman.MAX_DC_SIZE + 1)
+            diffs = np.where(sizes, 1 << np.maximum(sizes - 1, 0), 0)
+            zz[:, 0] = np.cumsum(diffs * (1 - 2 * (np.arange(len(zz)) % 2)))
+
+            self.assertGreater(ac_table.code_lengths.max(),
+                               huffman.LOOKUP_BITS)
+            components = np.zeros(len(zz), dtype=int)
+            writer = encode_blocks(zz, components, [dc_table], [ac_table])
+            writer.flush()
+            assert_array_equal(decode_blocks(writer.getvalue(), components,
+                                             [dc_table], [ac_table]), zz)
+
+    def test_optimal_table(self):
+        """Test optimal code lengths, limited to 16 bits"""
+        table = optimal_table([8, 4, 2, 1] + [0] * 252)
+        assert_array_equal(table.code_lengths[:5], [1, 2, 3, 4, 0])
+
+        # Doubling counts would give codes of up to 39 bits
+        counts = np.zeros(256, dtype=np.int64)
+        counts[:40] = 2**np.arange(40)
+        table = optimal_table(counts)
+        lengths = table.code_lengths[:40]
+        self.assertEqual(lengths.max(), 16)
+        self.assertTrue(np.all(np.diff(lengths) <= 0))
+        # The all 1 bits code is left unused
+        self.assertLess(np.sum(2.0**-lengths), 1)
+
+    def test_invalid_table(self):
+        with self.assertRaises(ValueError):
+            HuffmanTable([1] * 16, [0, 1])
+
+
+class TestBitWriter(unittest.TestCase):
+    def test_packing(self):
+        """Test MSB first packing and 1 bit padding"""
+        writer = BitWriter()
+        writer.write([0b101, 0b0], [3, 1])
+        writer.write([0b1], [2])
+        self.assertEqual(writer.getvalue(), b'')
+
+        writer.flush()
+        self.assertEqual(writer.getvalue(), b'\xa7')
+
+    def test_byte_stuffing(self):
+        """Test that 0xFF bytes are followed by a stuffed 0x00"""
+        writer = BitWriter()
+        writer.write([0xFF, 0x12, 0xFFFF], [8, 8, 16])
+        self.assertEqual(writer.getvalue(), b'\xff\x00\x12\xff\x00\xff\x00')
+
+    def test_chunks(self):
+        """Test that writes larger than a chunk pack the same bits"""
+        rng = np.random.RandomState(0)
+        lengths = rng.randint(1, 17, 1000)
+        values = rng.randint(0, 1 << 16, 1000) & ((1 << lengths) - 1)
+
+        writer = BitWriter()
+        writer.write(values, lengths)
+        writer.flush()
+
+        small = BitWriter()
+        small.CHUNK_SIZE = 7
+        small.write(values, lengths)
+        small.flush()
+
+        self.assertEqual(small.getvalue(), writer.getvalue())
+
+
+class TestBitReader(unittest.TestCase):
+    def test_unstuffing(self):
+        """Test that stuffed 0x00 bytes are removed and that reading stops
+        at a marker, padding with 0 bits"""
+        data = (bytes(range(1, 14)) + b'\xff\x00\x7f' + bytes(range(20, 30)) +
+                b'\xff\xd9\x55')
+        expected = bytes(range(1, 14)) + b'\xff\x7f' + bytes(range(20, 30))
+
+        reader = BitReader(memoryview(data))
+        acc = n_bits = 0
+        read = []
+        for _ in range(len(expected) + 8):
+            acc, n_bits = reader.fill(acc, n_bits)
+            self.assertGreaterEqual(n_bits, BitReader.MIN_BITS)
+            n_bits -= 8
+            read.append((acc >> n_bits) & 0xFF)
+
+        self.assertEqual(bytes(read), expected + bytes(8))
+        self.assertGreaterEqual(reader.padding - n_bits, 64)
+
+
+class TestEntropyCoding(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        zz = rng.randint(-60, 60, (12, 64))
+        zz[:, 1:] *= rng.uniform(size=(12, 63)) < 0.1
+        zz[0, 1:] = 0
+        zz[1, 1:63] = 0
+        zz[2, 40] = 1023
+        zz[3, 0] = 2000
+        self.zz = zz
+        self.components = np.tile([0, 1, 2], 4)
+        self.dc_tables = [huffman.DC_LUMINANCE, huffman.DC_CHROMINANCE,
+                          huffman.DC_CHROMINANCE]
+        self.ac_tables = [huffman.AC_LUMINANCE, huffman.AC_CHROMINANCE,
+                          huffman.AC_CHROMINANCE]
+
+    def test_scan_symbols(self):
+        """Test the run-length symbols of a single block"""
+        zz = np.zeros((2, 64), dtype=int)
+        zz[0, 0] = -3
+        zz[0, 2] = 1
+        zz[0, 20] = -5
+        zz[1, 0] = -3
+        zz[1, 63] = 2
+
+        block, is_ac, symbol, extra, extra_len = scan_symbols(zz, [0, 0])
+
+        assert_array_equal(block, [0, 0, 0, 0, 0, 1, 1, 1, 1, 1])
+        assert_array_equal(is_ac, [0, 1, 1, 1, 1, 0, 1, 1, 1, 1])
+        assert_array_equal(symbol, [0x02, 0x11, 0xF0, 0x13, 0x00,
+                                    0x00, 0xF0, 0xF0, 0xF0, 0xE2])
+        assert_array_equal(extra, [0b00, 0b1, 0, 0b010, 0,
+                                   0, 0, 0, 0, 0b10])
+        assert_array_equal(extra_len, [2, 1, 0, 3, 0, 0, 0, 0, 0, 2])
+
+    def test_round_trip(self):
+        """Test that decode_blocks inverts encode_blocks"""
+        writer = encode_blocks(self.zz, self.components, self.dc_tables,
+                               self.ac_tables)
+        writer.flush()
+
+        decoded = decode_blocks(writer.getvalue(), self.components,
+                                self.dc_tables, self.ac_tables)
+        assert_array_equal(decoded, self.zz)
+
+    def test_predictors(self):
+        """Test coding a scan in pieces that share DC predictors"""
+        writer = encode_blocks(self.zz, self.components, self.dc_tables,
+                               self.ac_tables)
+
+        pieces = BitWriter()
+        predictors = {}
+        for start in (0, 5):
+            stop = start + 5 if start == 0 else None
+            encode_blocks(self.zz[start:stop], self.components[start:stop],
+                          self.dc_tables, self.ac_tables, pieces, predictors)
+        self.assertEqual(predictors[0], self.zz[9, 0])
+
+        writer.flush()
+        pieces.flush()
+        self.assertEqual(pieces.getvalue(), writer.getvalue())
+
+    def test_scan_bits(self):
+        """Test that the bit count matches the coded scan"""
+        zz = self.zz.copy()
+        zz[4, 1:] = 0
+        zz[4, 40] = 5
+        writer = encode_blocks(zz, self.components, self.dc_tables,
+                               self.ac_tables)
+        n_bits = scan_bits(zz, self.components, self.dc_tables,
+                           self.ac_tables)
+        data = writer.getvalue()
+        self.assertEqual(n_bits // 8,
+                         len(data) - data.count(b'\xff\x00'))
+
+    def test_symbol_frequencies(self):
+        """Test that frequencies count the symbols of the coded scan, and
+        that optimal tables code it in fewer bits"""
+        for restart_interval in [4, 0]:
+            step = restart_interval or len(self.zz)
+            counts = np.zeros((2, 3, 256), dtype=np.int64)
+            for start in range(0, len(self.zz), step):
+                block, is_ac, symbol, _, _ = scan_symbols(
+                    self.zz[start:start + step],
+                    self.components[start:start + step])
+                comp = self.components[start:start + step][block]
+                np.add.at(counts, (is_ac.astype(int), comp, symbol), 1)
+
+            dc_counts, ac_counts = symbol_frequencies(
+                self.zz, self.components, 3, restart_interval)
+            assert_array_equal(dc_counts, counts[0])
+            assert_array_equal(ac_counts, counts[1])
+
+        # Tables built from the counts of a scan without restarts
+        dc_tables = [optimal_table(counts) for counts in dc_counts]
+        ac_tables = [optimal_table(counts) for counts in ac_counts]
+        writer = encode_blocks(self.zz, self.components, dc_tables,
+                               ac_tables)
+        writer.flush()
+        assert_array_equal(decode_blocks(writer.getvalue(), self.components,
+                                         dc_tables, ac_tables), self.zz)
+        self.assertLess(scan_bits(self.zz, self.components, dc_tables,
+                                  ac_tables),
+                        scan_bits(self.zz, self.components, self.dc_tables,
+                                  self.ac_tables))
+
+    def test_invalid_codes(self):
+        """Test that invalid codes and AC runs past the end of a block are
+        rejected"""
+        with self.assertRaises(ValueError):
+            decode_blocks(b'\xff\x00' * 4, [0], self.dc_tables,
+                          self.ac_tables)
+
+        # DC size 0, then five runs of 15 zeros followed by a 1 (0xF1)
+        data = BitWriter()
+        data.write([0b00] + [0b1111111111110101, 1] * 5, [2] + [16, 1] * 5)
+        data.flush()
+        with self.assertRaises(ValueError):
+            decode_blocks(data.getvalue(), [0], self.dc_tables,
+                          self.ac_tables)
+
+    def test_out_of_range(self):
+        """Test that coefficients too large for baseline JPEG are rejected"""
+        self.zz[5, 10] = 1024
+        with self.assertRaises(ValueError):
+            encode_blocks(self.zz, self.components, self.dc_tables,
+                          self.ac_tables)
+
+    def test_truncated(self):
+        """Test that truncated scan data raises an error"""
+        writer = encode_blocks(self.zz, self.components, self.dc_tables,
+                               self.ac_tables)
+        writer.flush()
+
+        with self.assertRaises(ValueError):
+            decode_blocks(writer.getvalue()[:20], self.components,
+                          self.dc_tables, self.ac_tables)
+
+    def test_long_codes(self):
+        """Test decoding codes longer than the lookup tables, including
+        symbols without extra bits"""
+        # Rare symbols, among them DC size 0, EOB and ZRL, get long codes
+        dc_counts = np.zeros(256, dtype=np.int64)
+        dc_counts[0] = 1
+        dc_counts[1:12] = 2**(20 - np.arange(1, 12))
+        ac_counts = np.zeros(256, dtype=np.int64)
+        ac_counts[[huffman.EOB, huffman.ZRL]] = 1
+        ac_counts[1:11] = 2**(20 - np.arange(1, 11))
+        ac_counts[[0x72, 0xE1]] = 2**10
+        dc_table = optimal_table(dc_counts)
+        ac_table = optimal_table(ac_counts)
+        self.assertGreater(dc_table.code_lengths[0], huffman.LOOKUP_BITS)
+        self.assertGreater(dc_table.code_lengths[11], huffman.LOOKUP_BITS)
+        self.assertGreater(ac_table.code_lengths[huffman.EOB],
+                           huffman.LOOKUP_BITS)
+        self.assertGreater(ac_table.code_lengths[huffman.ZRL],
+                           huffman.LOOKUP_BITS)
+
+        zz = np.zeros((4, 64), dtype=np.int64)
+        zz[:, 0] = [5, 5, -1000, -1000]
+        zz[0, 1:11] = 2**np.arange(10) - 1024 * (np.arange(10) % 2)
+        zz[1, 40] = 3
+        zz[2, 63] = -1
+        components = np.zeros(4, dtype=int)
+
+        writer = encode_blocks(zz, components, [dc_table], [ac_table])
+        writer.flush()
+        assert_array_equal(decode_blocks(writer.getvalue(), components,
+                                         [dc_table], [ac_table]), zz)
+
+    def test_restart_intervals(self):
+        """Test coding and decoding a scan with restart markers"""
+        writer = encode_blocks(self.zz, self.components, self.dc_tables,
+                               self.ac_tables, restart_interval=3)
+        writer.flush()
+        data = writer.getvalue()
+
+        segments = split_restart_intervals(data)
+        self.assertEqual(len(segments), 4)
+        for n in range(3):
+            self.assertEqual(data.count(bytes([0xFF, 0xD0 + n])), 1)
+
+        # The intervals are read in place, without copies of the scan
+        for segment in segments:
+            self.assertIsInstance(segment, memoryview)
+            self.assertIs(segment.obj, data)
+        self.assertEqual(sum(len(segment) for segment in segments),
+                         len(data) - 3 * 2)
+
+        # Each interval decodes on its own
+        assert_array_equal(decode_blocks(segments[1], self.components[3:6],
+                                         self.dc_tables, self.ac_tables),
+                           self.zz[3:6])
+        assert_array_equal(decode_intervals(segments, self.components,
+                                            self.dc_tables, self.ac_tables,
+                                            3),
+                           self.zz)
+        with self.assertRaises(ValueError):
+            decode_intervals(segments[:3], self.components, self.dc_tables,
+                             self.ac_tables, 3)
+
+        # Pieces that do not end on interval boundaries give the same scan
+        pieces = BitWriter()
+        predictors = {}
+        for start, stop in [(0, 4), (4, 5), (5, 12)]:
+            encode_blocks(self.zz[start:stop], self.components[start:stop],
+                          self.dc_tables, self.ac_tables, pieces, predictors,
+                          restart_interval=3, position=start)
+        pieces.flush()
+        self.assertEqual(pieces.getvalue(), data)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
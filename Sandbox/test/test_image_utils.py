@@ -3,7 +3,8 @@ import unittest
 import numpy as np
 from numpy.testing import assert_allclose
 
-from Sandbox.utils.image_utils import split_image, unsplit_image
+from Sandbox.utils.image_utils import (block_view, split_image, unsplit_image,
+                                       downsample, upsample)
 
 
 class TestImageSplitters(unittest.TestCase):
@@ -48,6 +49,117 @@ class TestImageSplitters(unittest.TestCase):
 
         assert_allclose(z, self.x)
 
+    def test_unsplit_array(self):
+        """Test unsplitting a (rows, cols, bh, bw) array of blocks"""
+        x = np.arange(16 * 24).reshape((16, 24))
+        blocks = block_view(x, (8, 4))
+        z = unsplit_image(blocks)
+        assert_allclose(z, x)
+        self.assertFalse(np.shares_memory(z, x))
+
+        # Stacked (n_blocks, bh, bw) arrays with a non-square grid
+        z = unsplit_image(np.array(split_image(x)), (2, 3))
+        assert_allclose(z, x)
+
+        # Leading axes are kept
+        z = unsplit_image(np.stack([blocks, -blocks]))
+        assert_allclose(z, np.stack([x, -x]))
+
+    def test_unsplit_out(self):
+        """Test that unsplit_image writes into a caller-supplied buffer"""
+        out = np.zeros((16, 16))
+        z = unsplit_image(split_image(self.x), (2, 2), out=out)
+        self.assertIs(z, out)
+        assert_allclose(out, self.x)
+
+        z = unsplit_image(np.array(split_image(self.x)), (2, 2), out=out)
+        self.assertIs(z, out)
+
+        with self.assertRaises(ValueError):
+            unsplit_image(split_image(self.x), (2, 2), out=np.zeros((8, 8)))
+
+        with self.assertRaises(ValueError):
+            unsplit_image(split_image(self.x), (2, 3))
+
+    def test_split_image_shape(self):
+        """Test that split_image honors split_shape"""
+        y = split_image(self.x, split_shape=(8, 4))
+        self.assertEqual(len(y), 8)
+        for n in range(len(y)):
+            self.assertEqual(y[n].shape, (8, 4))
+            assert_allclose(y[n], self.expected_y[n // 2][:, :4])
+
+
+class TestBlockView(unittest.TestCase):
+    def setUp(self):
+        self.x = np.arange(16 * 24).reshape((16, 24))
+
+    def test_block_view(self):
+        """Test that block_view tiles the image without copying"""
+        y = block_view(self.x)
+        self.assertEqual(y.shape, (2, 3, 8, 8))
+        self.assertTrue(np.shares_memory(y, self.x))
+        for row in range(2):
+            for col in range(3):
+                assert_allclose(y[row, col],
+                                self.x[8 * row:8 * row + 8,
+                                       8 * col:8 * col + 8])
+
+    def test_block_shape(self):
+        """Test block_view with non-square blocks and strided input"""
+        rgb = np.stack([self.x, -self.x], 2)
+        y = block_view(rgb[:, :, 1], block_shape=(4, 6))
+        self.assertEqual(y.shape, (4, 4, 4, 6))
+        self.assertTrue(np.shares_memory(y, rgb))
+        assert_allclose(y[1, 2], -self.x[4:8, 12:18])
+
+        # Leading axes are kept
+        y = block_view(np.moveaxis(rgb, 2, 0))
+        self.assertEqual(y.shape, (2, 2, 3, 8, 8))
+        assert_allclose(y[1, 1, 2], -self.x[8:16, 16:24])
+
+    def test_block_padding(self):
+        """Test that partial blocks are edge padded"""
+        x = self.x[:-3, :-2]
+        y = block_view(x)
+        self.assertEqual(y.shape, (2, 3, 8, 8))
+        assert_allclose(y.swapaxes(1, 2).reshape(16, 24)[:13, :22], x)
+        assert_allclose(y[1, 2, 5:, :6], np.tile(x[-1, 16:], (3, 1)))
+        assert_allclose(y[1, 2, :5, 6:], np.tile(x[8:, -1:], (1, 2)))
+
+
+class TestResampling(unittest.TestCase):
+    def test_downsample(self):
+        """Test box filter downsampling"""
+        x = np.arange(16.0).reshape((4, 4))
+        y = downsample(x, (2, 2))
+        assert_allclose(y, [[2.5, 4.5], [10.5, 12.5]])
+
+        y = downsample(x, (1, 2))
+        assert_allclose(y, [[0.5, 2.5], [4.5, 6.5], [8.5, 10.5],
+                            [12.5, 14.5]])
+
+        # Partial blocks are edge padded and leading axes kept
+        y = downsample(np.stack([x[:3], -x[:3]]), (2, 2))
+        assert_allclose(y, [[[2.5, 4.5], [8.5, 10.5]],
+                            [[-2.5, -4.5], [-8.5, -10.5]]])
+
+        self.assertIs(downsample(x, (1, 1)), x)
+
+        # Integer images are averaged in the requested float type
+        y = downsample(x.astype(np.uint8), (2, 2), np.float32)
+        self.assertEqual(y.dtype, np.float32)
+        assert_allclose(y, [[2.5, 4.5], [10.5, 12.5]])
+
+    def test_upsample(self):
+        """Test that upsample replicates pixels and inverts downsample"""
+        x = np.array([[1, 2], [3, 4]])
+        y = upsample(x, (2, 1))
+        assert_allclose(y, [[1, 2], [1, 2], [3, 4], [3, 4]])
+
+        y = upsample(x, (2, 2))
+        assert_allclose(downsample(y, (2, 2)), x)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from Sandbox.jpeg import huffman, jfif
+from Sandbox.jpeg.jfif import (JfifData, FrameComponent, read_jfif,
+                               write_jfif, read_segments, assign_table_ids)
+
+
+class TestJfif(unittest.TestCase):
+    def setUp(self):
+        table = np.arange(1, 65).reshape((8, 8))
+        components = [FrameComponent(1, 1, 1, 0, 0, 0),
+                      FrameComponent(2, 1, 1, 1, 1, 1)]
+        self.data = JfifData(
+            height=17, width=9, components=components,
+            quant_tables={0: table, 1: table.T},
+            dc_tables={0: huffman.DC_LUMINANCE, 1: huffman.DC_CHROMINANCE},
+            ac_tables={0: huffman.AC_LUMINANCE, 1: huffman.AC_CHROMINANCE},
+            scan_data=b'\x12\xff\x00\x34\xff\xd0\x56\x78')
+
+        self.stream = io.BytesIO()
+        write_jfif(self.stream, self.data)
+        self.stream.seek(0)
+
+    def test_segments(self):
+        """Test the order of the written segments"""
+        markers = [marker for marker, _ in read_segments(self.stream)]
+        self.assertEqual(markers, [jfif.SOI, jfif.APP0, jfif.DQT, jfif.DQT,
+                                   jfif.SOF0, jfif.DHT, jfif.DHT, jfif.DHT,
+                                   jfif.DHT, jfif.SOS, jfif.SCAN_DATA,
+                                   jfif.EOI])
+
+    def test_round_trip(self):
+        """Test that read_jfif inverts write_jfif"""
+        data = read_jfif(self.stream)
+
+        self.assertEqual((data.height, data.width), (17, 9))
+        self.assertEqual(data.scan_data, self.data.scan_data)
+        for n in range(2):
+            assert_array_equal(data.quant_tables[n],
+                               self.data.quant_tables[n])
+            assert_array_equal(data.dc_tables[n].values,
+                               self.data.dc_tables[n].values)
+            assert_array_equal(data.ac_tables[n].bits,
+                               self.data.ac_tables[n].bits)
+
+        self.assertEqual([comp.component_id for comp in data.components],
+                         [1, 2])
+        self.assertEqual([comp.quant_table for comp in data.components],
+                         [0, 1])
+        self.assertEqual([comp.ac_table for comp in data.components], [0, 1])
+
+    def test_incremental_read(self):
+        """Test that small stream reads split across markers still parse"""
+        for chunk_size in [1, 2, 3, 7]:
+            self.stream.seek(0)
+            data = read_jfif(self.stream, chunk_size=chunk_size)
+            self.assertEqual(data.scan_data, self.data.scan_data)
+
+    def test_invalid_stream(self):
+        """Test errors for non-JPEG and truncated streams"""
+        with self.assertRaises(ValueError):
+            read_jfif(io.BytesIO(b'GIF89a'))
+
+        truncated = io.BytesIO(self.stream.getvalue()[:-5])
+        with self.assertRaises(ValueError):
+            read_jfif(truncated)
+
+        quant_tables = {0: np.full((8, 8), 256)}
+        with self.assertRaises(ValueError):
+            write_jfif(io.BytesIO(), JfifData(quant_tables=quant_tables))
+
+    def test_table_ids(self):
+        """Test that equal tables share an id"""
+        table = np.ones((8, 8))
+        ids, unique = assign_table_ids([table, table * 2, table.copy()])
+        self.assertEqual(ids, [0, 1, 0])
+        self.assertEqual(len(unique), 2)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
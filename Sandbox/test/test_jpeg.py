@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import io
+import tempfile
 import numpy as np
 import skimage.data
 import unittest
+from PIL import Image
 from numpy.testing import (assert_allclose, assert_array_equal,
                            assert_array_almost_equal)
 
-from Sandbox.jpeg.jpeg import JpegCompressor
+from Sandbox.jpeg.jpeg import (JpegCompressor, CompressedImage,
+                               quantization_tables, LUMA_QUANT_TABLE,
+                               CHROMA_QUANT_TABLE)
 
 
 class TestImageFormatTransforms(unittest.TestCase):
@@ -72,6 +77,13 @@ class TestImageFormatTransforms(unittest.TestCase):
 
             self.assertAlmostEqual(y, (127 / 255)**gamma)
 
+    def test_gamma_table(self):
+        """Test that the uint8 lookup table matches the float computation"""
+        jpeg = JpegCompressor()
+        for gamma in [0.45, 1.0, 2.2]:
+            rgb_prime = jpeg.gamma_correct(self.data, gamma=gamma)
+            assert_allclose(rgb_prime, (self.data / 255.0)**gamma)
+
     def test_gamma_expansion(self):
         """Test that gamma_expand inverts gamma correct"""
         jpeg = JpegCompressor()
@@ -93,6 +105,21 @@ class TestImageFormatTransforms(unittest.TestCase):
         self.assertLessEqual(np.max(ycbcr_image), 255)
         self.assertEqual(ycbcr_image.dtype, np.uint8)
 
+    def test_rgb_to_ycbcr_values(self):
+        """Test the fused conversion against the per-channel formulas"""
+        jpeg = JpegCompressor()
+        rgb_prime = jpeg.gamma_correct(self.data.astype(float), jpeg.gamma)
+        r, g, b = [rgb_prime[:, :, n] for n in range(3)]
+
+        y = jpeg._k_r * r + jpeg._k_g * g + jpeg._k_b * b
+        c_b = 0.5 * (b - y) / (1.0 - jpeg._k_b) + 0.5
+        c_r = 0.5 * (r - y) / (1.0 - jpeg._k_r) + 0.5
+        expected = np.stack([y, c_b, c_r], 2) * 255
+
+        # Allow for rounding of values within floating point error of x.5
+        assert_allclose(jpeg.rgb_to_ycbcr(self.data), expected,
+                        atol=0.5 + 1e-9)
+
     def test_ycbcr_to_rgb(self):
         """Test the ycbcr_to_rgb inverts rgb_to_ycbcr"""
         jpeg = JpegCompressor()
@@ -132,25 +159,216 @@ class TestJpegCompressor(unittest.TestCase):
         compressed = jpeg.compress(self.data)
 
         # Test that all the data types are correct
-        self.assertIsInstance(compressed, np.ndarray)
-        for elem in compressed:
+        self.assertIsInstance(compressed, CompressedImage)
+        for elem in compressed.coefficients:
             self.assertIsInstance(elem, np.ndarray)
 
         for chan in range(3):
-            block_0 = compressed[chan][0]
+            block_0 = compressed.coefficients[chan][0, 0]
             self.assertEqual(block_0.shape, (8, 8))
             self.assertEqual(block_0.dtype.kind, 'i')
 
+        # Test the image geometry
+        self.assertEqual((compressed.height, compressed.width), (512, 512))
+        self.assertEqual(compressed.grid, (64, 64))
+        self.assertEqual(compressed.padding, (0, 0))
+        self.assertEqual(compressed.dtype.kind, 'i')
+        self.assertEqual(len(compressed.quant_tables), 3)
+
         # Test that the compressed data is equal or smaller than the input
         self.assertLessEqual(compressed.size, self.data.size)
 
         # In the current chain, there should be more zeros after compression
         nonzero_in = np.count_nonzero(self.data)
-        nonzero_out = np.count_nonzero(compressed)
+        nonzero_out = sum(np.count_nonzero(coeffs)
+                          for coeffs in compressed.coefficients)
         self.assertLess(nonzero_out, nonzero_in)
 
         # TODO: Need a test to check value correctness
 
+    def test_entropy_coding(self):
+        """Test that entropy coding is lossless and shrinks the data"""
+        jpeg = JpegCompressor()
+        compressed = jpeg.compress(self.data[:100, :75])
+        data = jpeg.entropy_encode(compressed)
+
+        self.assertIsInstance(data, bytes)
+        self.assertLess(len(data), self.data[:100, :75].size / 5)
+
+        decoded = jpeg.entropy_decode(data, 100, 75)
+        self.assertEqual((decoded.height, decoded.width), (100, 75))
+        for coeffs, expected in zip(decoded.coefficients,
+                                    compressed.coefficients):
+            assert_array_equal(coeffs, expected)
+
+    def test_quantization_tables(self):
+        """Test IJG quality scaling of the luma and chroma tables"""
+        (luma, chroma), (luma_recip, _) = quantization_tables(50)
+        assert_array_equal(luma, LUMA_QUANT_TABLE)
+        assert_array_equal(chroma, CHROMA_QUANT_TABLE)
+        assert_allclose(luma_recip * luma, 1)
+
+        (luma, chroma), _ = quantization_tables(100)
+        assert_array_equal(luma, 1)
+        assert_array_equal(chroma, 1)
+
+        (luma, chroma), _ = quantization_tables(10)
+        self.assertEqual(luma[0, 0], 80)
+        self.assertEqual(chroma.max(), 255)
+
+        with self.assertRaises(ValueError):
+            quantization_tables(0)
+        with self.assertRaises(ValueError):
+            quantization_tables(75.5)
+        with self.assertRaises(ValueError):
+            JpegCompressor(quality=75.5)
+
+        # Integral floats and numpy integers give the integer tables
+        (luma, _), _ = quantization_tables(np.int64(80))
+        assert_array_equal(luma, quantization_tables(80.0)[0][0])
+        self.assertEqual(luma.dtype.kind, 'i')
+
+    def test_quality(self):
+        """Test that quality trades size for fidelity and that compressors
+        share cached tables"""
+        data = self.data[:64, :64]
+        sizes = []
+        errors = []
+        for quality in (20, 75, 95):
+            jpeg = JpegCompressor(quality=quality)
+            self.assertIs(jpeg.quant_tables[1],
+                          JpegCompressor(quality=quality).quant_tables[1])
+            self.assertIs(jpeg.quant_tables[1], jpeg.quant_tables[2])
+            self.assertFalse(jpeg.Q.flags.writeable)
+
+            compressed = jpeg.compress(data)
+            sizes.append(len(jpeg.entropy_encode(compressed)))
+            error = jpeg.decompress(compressed) - data.astype(float)
+            errors.append(np.sqrt(np.mean(error**2)))
+
+        self.assertEqual(sizes, sorted(sizes))
+        self.assertEqual(errors, sorted(errors, reverse=True))
+
+    def test_compress_to_size(self):
+        """Test that the highest quality that fits the budget is chosen"""
+        def file_size(jpeg, compressed):
+            stream = io.BytesIO()
+            jpeg.write(compressed, stream)
+            return len(stream.getvalue())
+
+        data = self.data[:200, :136]
+        for subsampling, max_bytes in [('4:4:4', 6000), ('4:2:0', 12000)]:
+            jpeg = JpegCompressor(subsampling=subsampling)
+            compressed = jpeg.compress_to_size(data, max_bytes)
+            self.assertLessEqual(file_size(jpeg, compressed), max_bytes)
+
+            quality = [q for q in range(1, 101)
+                       if np.array_equal(quantization_tables(q)[0][0],
+                                         compressed.quant_tables[0])][-1]
+            expected = JpegCompressor(subsampling=subsampling,
+                                      quality=quality).compress(data)
+            for coeffs, expected_coeffs in zip(compressed.coefficients,
+                                               expected.coefficients):
+                assert_array_equal(coeffs, expected_coeffs)
+
+            better = JpegCompressor(subsampling=subsampling,
+                                    quality=quality + 1)
+            self.assertGreater(file_size(better, better.compress(data)),
+                               max_bytes)
+
+        with self.assertRaises(ValueError):
+            JpegCompressor().compress_to_size(data, 1000)
+
+    def test_fixed_engine(self):
+        """Test the fixed-point engine against the float engine"""
+        data = self.data[:100, :75]
+        for subsampling in ('4:4:4', '4:2:0'):
+            jpeg = JpegCompressor(subsampling=subsampling)
+            fixed = JpegCompressor(subsampling=subsampling, engine='fixed')
+
+            compressed = jpeg.compress(data)
+            fixed_compressed = fixed.compress(data)
+            for coeffs, expected in zip(fixed_compressed.coefficients,
+                                        compressed.coefficients):
+                self.assertLessEqual(np.max(np.abs(coeffs - expected)), 1)
+
+            # Within one Y'CbCr level, amplified by the gamma expansion
+            error = (fixed.decompress(compressed) -
+                     jpeg.decompress(compressed).astype(float))
+            self.assertLessEqual(np.max(np.abs(error)), 4)
+
+        with self.assertRaises(ValueError):
+            JpegCompressor(engine='double')
+
+    def test_compact_dtypes(self):
+        """Test the float32 and int16 dtype policy"""
+        data = self.data[:100, :75]
+        for engine in ('float', 'fixed'):
+            jpeg = JpegCompressor(engine=engine, subsampling='4:2:0')
+            compact = JpegCompressor(engine=engine, subsampling='4:2:0',
+                                     float_dtype=np.float32,
+                                     coeff_dtype=np.int16)
+            self.assertEqual(compact.rgb_to_ypbpr(data).dtype, np.float32)
+
+            compressed = jpeg.compress(data)
+            compact_compressed = compact.compress(data)
+            self.assertEqual(compact_compressed.dtype, np.int16)
+            for coeffs, expected in zip(compact_compressed.coefficients,
+                                        compressed.coefficients):
+                self.assertEqual(coeffs.dtype, np.int16)
+                self.assertLessEqual(np.max(np.abs(coeffs - expected)), 1)
+
+            error = (compact.decompress(compressed) -
+                     jpeg.decompress(compressed).astype(float))
+            self.assertLessEqual(np.max(np.abs(error)), 1)
+
+            data_bytes = compact.entropy_encode(compact_compressed)
+            self.assertEqual(compact.entropy_decode(data_bytes, 100, 75).dtype,
+                             np.int16)
+
+        with self.assertRaises(ValueError):
+            JpegCompressor(float_dtype=np.int32)
+        with self.assertRaises(ValueError):
+            JpegCompressor(coeff_dtype=np.int8)
+
+    def test_subsampling(self):
+        """Test the coefficient grids of each chroma subsampling mode"""
+        expected_grids = {'4:4:4': [(13, 10), (13, 10), (13, 10)],
+                          '4:2:2': [(13, 10), (13, 5), (13, 5)],
+                          '4:2:0': [(14, 10), (7, 5), (7, 5)]}
+        for mode, grids in expected_grids.items():
+            jpeg = JpegCompressor(subsampling=mode)
+            compressed = jpeg.compress(self.data[:100, :75])
+
+            self.assertEqual([coeffs.shape[:2]
+                              for coeffs in compressed.coefficients], grids)
+            self.assertEqual(compressed.grid, grids[0])
+
+            decompressed = jpeg.decompress(compressed)
+            self.assertEqual(decompressed.shape, (100, 75, 3))
+            error = decompressed - self.data[:100, :75].astype(float)
+            self.assertLess(np.sqrt(np.mean(error**2)), 8)
+
+            data = jpeg.entropy_encode(compressed)
+            decoded = jpeg.entropy_decode(data, 100, 75)
+            for coeffs, expected in zip(decoded.coefficients,
+                                        compressed.coefficients):
+                assert_array_equal(coeffs, expected)
+
+        with self.assertRaises(ValueError):
+            JpegCompressor(subsampling='4:1:1')
+
+    def test_compress_geometry(self):
+        """Test the container geometry for sizes that are not block multiple"""
+        jpeg = JpegCompressor()
+        compressed = jpeg.compress(self.data[:100, :75])
+
+        self.assertEqual((compressed.height, compressed.width), (100, 75))
+        self.assertEqual(compressed.grid, (13, 10))
+        self.assertEqual(compressed.padding, (4, 5))
+        for coeffs in compressed.coefficients:
+            self.assertEqual(coeffs.shape, (13, 10, 8, 8))
+
 
 class TestJpegDecompressor(unittest.TestCase):
     """Test that the decompression chain inverts the compression chain"""
@@ -167,6 +385,291 @@ class TestJpegDecompressor(unittest.TestCase):
         # Check that RMS error after decompression is arbitrarily small
         self.assertLess(rms_error, 5)
 
+    def test_decompress_sizes(self):
+        """Test decompression of images that are not 512x512"""
+        jpeg = JpegCompressor()
+        for shape in [(100, 75), (64, 200), (9, 9)]:
+            data = self.data[:shape[0], :shape[1]]
+            decompressed = jpeg.decompress(jpeg.compress(data))
+
+            self.assertEqual(decompressed.shape, data.shape)
+            error = decompressed - data.astype(float)
+            rms_error = np.sqrt(np.mean(error**2))
+            self.assertLess(rms_error, 8)
+
+    def test_reduced_decode(self):
+        """Test that reduced decodes approximate the shrunk full decode"""
+        data = self.data[:509, :301]
+        for subsampling in ('4:4:4', '4:2:0'):
+            jpeg = JpegCompressor(gamma=1.0, subsampling=subsampling)
+            compressed = jpeg.compress(data)
+            full = jpeg.decompress(compressed).astype(float)
+
+            for reduction in (2, 4, 8):
+                reduced = jpeg.decompress(compressed, reduction)
+                height, width = -(-509 // reduction), -(-301 // reduction)
+                self.assertEqual(reduced.shape, (height, width, 3))
+
+                padded = np.pad(full, ((0, height * reduction - 509),
+                                       (0, width * reduction - 301), (0, 0)),
+                                mode='edge')
+                shrunk = padded.reshape(height, reduction, width, reduction,
+                                        3).mean(axis=(1, 3))
+                rms_error = np.sqrt(np.mean((reduced - shrunk)**2))
+                self.assertLess(rms_error, 8)
+
+        # At 1/8 scale each pixel is the mean of its block
+        jpeg = JpegCompressor(gamma=1.0)
+        compressed = jpeg.compress(self.data)
+        shrunk = jpeg.decompress(compressed).reshape(64, 8, 64, 8, 3)
+        assert_allclose(jpeg.decompress(compressed, 8),
+                        shrunk.mean(axis=(1, 3)), atol=3)
+
+        with self.assertRaises(ValueError):
+            jpeg.decompress(compressed, 3)
+
+    def test_decompress_region(self):
+        """Test that region decodes match crops of the full decode"""
+        data = self.data[:203, :157]
+        for subsampling in ('4:4:4', '4:2:0'):
+            jpeg = JpegCompressor(subsampling=subsampling)
+            compressed = jpeg.compress(data)
+            full = jpeg.decompress(compressed)
+
+            for top, left, height, width in [(0, 0, 203, 157),
+                                             (17, 33, 50, 41),
+                                             (190, 150, 40, 40),
+                                             (-5, 100, 10, 8)]:
+                region = jpeg.decompress_region(compressed, top, left,
+                                                height, width)
+                assert_array_equal(region, full[max(top, 0):top + height,
+                                                max(left, 0):left + width])
+
+            with self.assertRaises(ValueError):
+                jpeg.decompress_region(compressed, 203, 0, 8, 8)
+
+
+class TestJpegBatch(unittest.TestCase):
+    """Test batch compression and decompression"""
+    def setUp(self):
+        data = skimage.data.astronaut()
+        self.images = [data[:40, :48], data[100:140, :48], data[:21, :13],
+                       data[200:240, 300:348], data[50:71, 50:63]]
+
+    def test_compress_many(self):
+        """Test that batches match compressing each image"""
+        for subsampling in ('4:4:4', '4:2:0'):
+            jpeg = JpegCompressor(subsampling=subsampling)
+            batch = jpeg.compress_many(self.images)
+
+            self.assertEqual(len(batch), len(self.images))
+            for compressed, image in zip(batch, self.images):
+                expected = jpeg.compress(image)
+                self.assertEqual((compressed.height, compressed.width),
+                                 image.shape[:2])
+                for coeffs, expected_coeffs in zip(compressed.coefficients,
+                                                   expected.coefficients):
+                    assert_array_equal(coeffs, expected_coeffs)
+
+    def test_decompress_many(self):
+        """Test that batches match decompressing each image"""
+        jpeg = JpegCompressor(subsampling='4:2:2')
+        compressed = jpeg.compress_many(self.images)
+
+        # JFIF bytes and CompressedImages may be mixed
+        stream = io.BytesIO()
+        jpeg.write(compressed[1], stream)
+        payloads = list(compressed)
+        payloads[1] = stream.getvalue()
+
+        decoded = jpeg.decompress_many(payloads)
+        for image, item in zip(decoded, compressed):
+            assert_array_equal(image, jpeg.decompress(item))
+
+        decoded = jpeg.decompress_many(payloads, reduction=4)
+        for image, item in zip(decoded, compressed):
+            assert_array_equal(image, jpeg.decompress(item, 4))
+
+
+class TestJpegFiles(unittest.TestCase):
+    """Test reading and writing JFIF files"""
+    def setUp(self):
+        self.data = skimage.data.astronaut()[:100, :75]
+
+    def test_write_read(self):
+        """Test that read inverts write"""
+        jpeg = JpegCompressor()
+        compressed = jpeg.compress(self.data)
+        stream = io.BytesIO()
+        jpeg.write(compressed, stream)
+
+        self.assertTrue(stream.getvalue().startswith(b'\xff\xd8\xff\xe0'))
+        self.assertTrue(stream.getvalue().endswith(b'\xff\xd9'))
+
+        stream.seek(0)
+        decoded = jpeg.read(stream)
+        self.assertEqual((decoded.height, decoded.width), (100, 75))
+        for coeffs, expected in zip(decoded.coefficients,
+                                    compressed.coefficients):
+            assert_array_equal(coeffs, expected)
+
+    def test_write_stream(self):
+        """Test that streamed files match files of the whole image"""
+        for subsampling in ('4:4:4', '4:2:0'):
+            jpeg = JpegCompressor(subsampling=subsampling)
+            expected = io.BytesIO()
+            jpeg.write(jpeg.compress(self.data), expected)
+
+            stream = io.BytesIO()
+            jpeg.write_stream(self.data, stream)
+            self.assertEqual(stream.getvalue(), expected.getvalue())
+
+            # Strips that do not line up with the MCU rows
+            strips = (self.data[start:start + 7]
+                      for start in range(0, 100, 7))
+            stream = io.BytesIO()
+            jpeg.write_stream(strips, stream, height=100)
+            self.assertEqual(stream.getvalue(), expected.getvalue())
+
+    def test_write_stream_memmap(self):
+        """Test streaming a memory mapped image"""
+        with tempfile.TemporaryFile() as f:
+            image = np.memmap(f, dtype=np.uint8, shape=self.data.shape)
+            image[...] = self.data
+
+            jpeg = JpegCompressor()
+            stream = io.BytesIO()
+            jpeg.write_stream(image, stream)
+            del image
+
+        stream.seek(0)
+        decoded = jpeg.read(stream)
+        for coeffs, expected in zip(decoded.coefficients,
+                                    jpeg.compress(self.data).coefficients):
+            assert_array_equal(coeffs, expected)
+
+    def test_write_stream_height(self):
+        jpeg = JpegCompressor()
+        with self.assertRaises(ValueError):
+            jpeg.write_stream(iter([self.data]), io.BytesIO())
+        with self.assertRaises(ValueError):
+            jpeg.write_stream(iter([self.data]), io.BytesIO(), height=120)
+
+    def test_write_stream_empty(self):
+        jpeg = JpegCompressor()
+        stream = io.BytesIO()
+        with self.assertRaisesRegex(ValueError, 'No image strips'):
+            jpeg.write_stream(iter([]), stream, height=16)
+        with self.assertRaisesRegex(ValueError, 'No image strips'):
+            jpeg.write_stream(self.data[:0], stream)
+        self.assertEqual(stream.getvalue(), b'')
+
+    def test_standard_decoder(self):
+        """Test that a standard decoder reads our files"""
+        jpeg = JpegCompressor(gamma=1.0)
+        stream = io.BytesIO()
+        jpeg.write(jpeg.compress(self.data), stream)
+        stream.seek(0)
+
+        decoded = np.asarray(Image.open(stream).convert('RGB'))
+        self.assertEqual(decoded.shape, self.data.shape)
+
+        rms_error = np.sqrt(np.mean((decoded - self.data.astype(float))**2))
+        self.assertLess(rms_error, 8)
+
+    def test_optimized_tables(self):
+        """Test that optimized Huffman tables give smaller files that read
+        back, with restart intervals too, and decode with a standard
+        decoder"""
+        for mode, restart_interval in [('4:4:4', 0), ('4:2:0', 3)]:
+            jpeg = JpegCompressor(gamma=1.0, subsampling=mode,
+                                  restart_interval=restart_interval)
+            optimized = JpegCompressor(gamma=1.0, subsampling=mode,
+                                       restart_interval=restart_interval,
+                                       optimize=True)
+            compressed = jpeg.compress(self.data)
+            standard, stream = io.BytesIO(), io.BytesIO()
+            jpeg.write(compressed, standard)
+            optimized.write(compressed, stream)
+            self.assertLess(len(stream.getvalue()),
+                            len(standard.getvalue()))
+
+            stream.seek(0)
+            decoded = jpeg.read(stream)
+            for coeffs, expected in zip(decoded.coefficients,
+                                        compressed.coefficients):
+                assert_array_equal(coeffs, expected)
+
+            stream.seek(0)
+            decoded = np.asarray(Image.open(stream).convert('RGB'))
+            assert_array_equal(
+                decoded, np.asarray(Image.open(standard).convert('RGB')))
+
+    def test_read_standard_file(self):
+        """Test reading files written by a standard encoder"""
+        jpeg = JpegCompressor(gamma=1.0)
+        for subsampling in [0, 1, 2]:
+            stream = io.BytesIO()
+            Image.fromarray(self.data).save(stream, 'JPEG', quality=90,
+                                            subsampling=subsampling)
+            stream.seek(0)
+
+            decoded = jpeg.decompress(jpeg.read(stream))
+            self.assertEqual(decoded.shape, self.data.shape)
+
+            error = decoded - self.data.astype(float)
+            self.assertLess(np.sqrt(np.mean(error**2)), 8)
+
+    def test_subsampled_file(self):
+        """Test that a standard decoder reads subsampled files"""
+        for mode in ['4:2:2', '4:2:0']:
+            jpeg = JpegCompressor(gamma=1.0, subsampling=mode)
+            compressed = jpeg.compress(self.data)
+            stream = io.BytesIO()
+            jpeg.write(compressed, stream)
+
+            stream.seek(0)
+            decoded = jpeg.read(stream)
+            self.assertEqual(decoded.sampling, compressed.sampling)
+
+            stream.seek(0)
+            decoded = np.asarray(Image.open(stream).convert('RGB'))
+            error = decoded - self.data.astype(float)
+            self.assertLess(np.sqrt(np.mean(error**2)), 8)
+
+    def test_restart_markers(self):
+        """Test files with restart intervals against a standard decoder,
+        the streaming writer and parallel decoding"""
+        for mode in ['4:4:4', '4:2:0']:
+            jpeg = JpegCompressor(gamma=1.0, subsampling=mode,
+                                  restart_interval=5)
+            compressed = jpeg.compress(self.data)
+            stream = io.BytesIO()
+            jpeg.write(compressed, stream)
+            data = stream.getvalue()
+            self.assertIn(b'\xff\xd0', data)
+
+            streamed = io.BytesIO()
+            jpeg.write_stream(self.data, streamed)
+            self.assertEqual(streamed.getvalue(), data)
+
+            decoded = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+            error = decoded - self.data.astype(float)
+            self.assertLess(np.sqrt(np.mean(error**2)), 8)
+
+            for kwargs in [{}, {'workers': 2, 'pool': 'thread'},
+                           {'workers': 2}]:
+                reader = JpegCompressor(**kwargs)
+                reader.PARALLEL_MIN_PIXELS = 0
+                decoded = reader.read(io.BytesIO(data))
+                reader.close()
+                for coeffs, expected in zip(decoded.coefficients,
+                                            compressed.coefficients):
+                    assert_array_equal(coeffs, expected)
+
+        with self.assertRaises(ValueError):
+            JpegCompressor(restart_interval=1 << 16)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+import skimage.data
+from numpy.testing import assert_array_equal
+
+from Sandbox.jpeg import parallel
+from Sandbox.jpeg.jpeg import JpegCompressor
+from Sandbox.jpeg.parallel import band_slices, SharedBuffer
+from Sandbox.jpeg.stats import PipelineStats
+
+
+class TestParallelEncoding(unittest.TestCase):
+    def setUp(self):
+        # Odd size so the last band and column of MCUs are padded
+        self.data = skimage.data.astronaut()[:203, :157]
+
+    def parallel_compressor(self, subsampling, **kwargs):
+        """Return a compressor that uses its pool even for small images"""
+        jpeg = JpegCompressor(subsampling=subsampling, **kwargs)
+        jpeg.PARALLEL_MIN_PIXELS = 0
+        self.addCleanup(jpeg.close)
+        return jpeg
+
+    def assert_matches_serial(self, compressed, subsampling):
+        serial = JpegCompressor(subsampling=subsampling).compress(self.data)
+
+        self.assertEqual(compressed.sampling, serial.sampling)
+        for coeffs, expected in zip(compressed.coefficients,
+                                    serial.coefficients):
+            assert_array_equal(coeffs, expected)
+
+    def test_band_slices(self):
+        self.assertEqual(band_slices(7, 3), [(0, 3), (3, 6), (6, 7)])
+        self.assertEqual(band_slices(2, 5), [(0, 2)])
+
+    def test_thread_pool(self):
+        """Test that thread pool bands match the serial encoding"""
+        for subsampling in ('4:4:4', '4:2:0'):
+            jpeg = self.parallel_compressor(subsampling, workers=3,
+                                            band_height=20, pool='thread')
+            self.assert_matches_serial(jpeg.compress(self.data), subsampling)
+
+    def test_process_pool(self):
+        """Test that shared memory process pool bands match the serial
+        encoding"""
+        for subsampling in ('4:4:4', '4:2:2'):
+            for band_height in (None, 40):
+                jpeg = self.parallel_compressor(subsampling, workers=2,
+                                                band_height=band_height)
+                self.assert_matches_serial(jpeg.compress(self.data),
+                                           subsampling)
+
+    def test_without_shared_memory(self):
+        """Test the pickling process pool of Pythons before 3.8"""
+        stats = PipelineStats()
+        with mock.patch.object(parallel, 'shared_memory', None):
+            jpeg = self.parallel_compressor('4:2:0', workers=2,
+                                            band_height=20, stats=stats)
+            self.assert_matches_serial(jpeg.compress(self.data), '4:2:0')
+            image = jpeg.shared_image(self.data.shape)
+            image[...] = self.data
+            self.assert_matches_serial(jpeg.compress(image), '4:2:0')
+
+        # Seven bands of 32 rows per image, recorded by the workers
+        self.assertEqual(stats['rgb_to_ycbcr'].calls, 14)
+        self.assertEqual(stats['encode_bands'].calls, 2)
+
+    def test_pool_reuse(self):
+        """Test that the pool and staging buffer are kept between calls and
+        that results stay valid after later calls"""
+        jpeg = self.parallel_compressor('4:2:0', workers=2)
+        first = jpeg.compress(self.data)
+        pool = jpeg._workers
+        executor, staging = pool._executor, pool._staging
+        second = jpeg.compress(self.data[::-1])
+
+        self.assertIs(jpeg._workers._executor, executor)
+        self.assertIs(jpeg._workers._staging, staging)
+        self.assert_matches_serial(first, '4:2:0')
+
+        # Coefficients are the shared memory the workers wrote
+        self.assertIsInstance(first.coefficients[0].base.base, SharedBuffer)
+        self.assertFalse(second.coefficients[0].base.base.linked)
+
+        jpeg.close()
+        self.assertIsNone(jpeg._workers)
+        self.assert_matches_serial(jpeg.compress(self.data), '4:2:0')
+
+    def test_shared_image(self):
+        """Test that images in shared memory are not staged"""
+        jpeg = self.parallel_compressor('4:4:4', workers=2)
+        image = jpeg.shared_image(self.data.shape)
+        image[...] = self.data
+
+        self.assert_matches_serial(jpeg.compress(image), '4:4:4')
+        self.assertIsNone(jpeg._workers._staging)
+
+    def test_small_images(self):
+        """Test that images below PARALLEL_MIN_PIXELS are encoded serially"""
+        with JpegCompressor(workers=2) as jpeg:
+            self.assert_matches_serial(jpeg.compress(self.data), '4:4:4')
+            self.assertIsNone(jpeg._workers)
+
+    def test_invalid_pool(self):
+        with self.assertRaises(ValueError):
+            JpegCompressor(workers=2, pool='cluster')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
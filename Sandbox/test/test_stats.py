@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import io
+import pickle
+import tracemalloc
+import unittest
+import skimage.data
+from numpy.testing import assert_array_equal
+
+from Sandbox.jpeg.jpeg import JpegCompressor
+from Sandbox.jpeg.stats import PipelineStats
+
+
+class TestPipelineStats(unittest.TestCase):
+    def setUp(self):
+        self.data = skimage.data.astronaut()[:64, :48]
+
+    def test_stages(self):
+        """Test that every stage of compress and decompress is recorded
+        without changing the results"""
+        stats = PipelineStats()
+        jpeg = JpegCompressor(stats=stats)
+        compressed = jpeg.compress(self.data)
+        image = jpeg.decompress(compressed)
+
+        plain = JpegCompressor()
+        for coeffs, expected in zip(compressed.coefficients,
+                                    plain.compress(self.data).coefficients):
+            assert_array_equal(coeffs, expected)
+        assert_array_equal(image, plain.decompress(compressed))
+
+        self.assertEqual(set(stats.stages),
+                         {'rgb_to_ycbcr', 'split', 'dct', 'quantize',
+                          'dequantize', 'idct', 'reassemble',
+                          'ycbcr_to_rgb'})
+        self.assertEqual(stats['rgb_to_ycbcr'].calls, 1)
+        self.assertEqual(stats['split'].calls, 3)
+        self.assertEqual(stats['reassemble'].calls, 3)
+        self.assertEqual(stats['rgb_to_ycbcr'].bytes, self.data.nbytes)
+        self.assertEqual(stats['dct'].calls, 3)
+        self.assertEqual(stats['quantize'].bytes, 3 * 64 * 48 * 8)
+        for stage in stats.stages.values():
+            self.assertGreaterEqual(stage.seconds, 0)
+            self.assertEqual(stage.peak_memory, 0)
+
+    def test_subsampled_stages(self):
+        """Test that only subsampled components are resampled"""
+        stats = PipelineStats()
+        jpeg = JpegCompressor(subsampling='4:2:0', stats=stats)
+        jpeg.decompress(jpeg.compress(self.data))
+
+        self.assertEqual(stats['split'].calls, 3)
+        self.assertEqual(stats['downsample'].calls, 2)
+        self.assertEqual(stats['reassemble'].calls, 3)
+        self.assertEqual(stats['upsample'].calls, 2)
+
+    def test_entropy_stages(self):
+        stats = PipelineStats()
+        jpeg = JpegCompressor(engine='fixed', stats=stats)
+        f = io.BytesIO()
+        jpeg.write(jpeg.compress(self.data), f)
+        jpeg.read(io.BytesIO(f.getvalue()))
+
+        self.assertNotIn('quantize', stats.stages)
+        self.assertEqual(stats['entropy_encode'].calls, 1)
+        self.assertEqual(stats['entropy_decode'].calls, 1)
+        self.assertGreater(stats['entropy_decode'].bytes, 0)
+
+    def test_hooks(self):
+        calls = []
+        stats = PipelineStats(hooks=[lambda *args: calls.append(args)])
+        JpegCompressor(stats=stats).compress(self.data)
+
+        self.assertEqual(len(calls),
+                         sum(stage.calls for stage in stats.stages.values()))
+        name, seconds, nbytes, peak_memory = calls[0]
+        self.assertEqual(name, 'rgb_to_ycbcr')
+        self.assertEqual(nbytes, self.data.nbytes)
+
+    def test_trace_memory(self):
+        tracing = tracemalloc.is_tracing()
+        try:
+            stats = PipelineStats(trace_memory=True)
+            JpegCompressor(stats=stats).compress(self.data)
+            self.assertTrue(tracemalloc.is_tracing())
+            self.assertGreater(stats['dct'].peak_memory, 0)
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+    def test_trace_memory_fallback(self):
+        """Test peak memory on Pythons before 3.9, without reset_peak"""
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        tracing = tracemalloc.is_tracing()
+        if reset_peak is not None:
+            del tracemalloc.reset_peak
+        try:
+            stats = PipelineStats(trace_memory=True)
+            JpegCompressor(stats=stats).compress(self.data)
+            self.assertGreater(stats['dct'].peak_memory, 0)
+        finally:
+            if reset_peak is not None:
+                tracemalloc.reset_peak = reset_peak
+            if not tracing:
+                tracemalloc.stop()
+
+    def test_reset(self):
+        stats = PipelineStats()
+        JpegCompressor(stats=stats).compress(self.data)
+        self.assertEqual(stats.as_dict()['dct']['calls'], 3)
+        stats.reset()
+        self.assertEqual(stats.as_dict(), {})
+
+    def test_pickle(self):
+        """Test that pickled copies, as sent to process pool workers, are
+        empty and drop the hooks"""
+        stats = PipelineStats(hooks=[lambda *args: None])
+        JpegCompressor(stats=stats).compress(self.data)
+
+        copy = pickle.loads(pickle.dumps(stats))
+        self.assertEqual(copy.stages, {})
+        self.assertEqual(copy.hooks, [])
+
+    def test_process_pool(self):
+        """Test that stages run in process pool workers are recorded, and
+        passed to the hooks, as the workers finish"""
+        calls = []
+        stats = PipelineStats(hooks=[lambda *args: calls.append(args[0])])
+        with JpegCompressor(workers=2, band_height=16, stats=stats) as jpeg:
+            jpeg.PARALLEL_MIN_PIXELS = 0
+            jpeg.compress(self.data)
+
+        # Four bands of every component, and the whole parallel compress
+        self.assertEqual(stats['rgb_to_ycbcr'].calls, 4)
+        self.assertEqual(stats['dct'].calls, 12)
+        self.assertEqual(stats['quantize'].bytes, 3 * 64 * 48 * 8)
+        self.assertEqual(stats['encode_bands'].calls, 1)
+        self.assertEqual(stats['encode_bands'].bytes, self.data.nbytes)
+        self.assertEqual(len(calls),
+                         sum(stage.calls for stage in stats.stages.values()))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
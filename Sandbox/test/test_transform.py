@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+import numpy as np
+import skimage.data
+from PIL import Image
+from numpy.testing import assert_array_equal
+
+from Sandbox.jpeg.jpeg import JpegCompressor
+from Sandbox.jpeg.transform import (flip_horizontal, flip_vertical,
+                                    transpose, rotate, crop)
+
+
+class TestLosslessTransforms(unittest.TestCase):
+    def setUp(self):
+        # Odd size, so flips and rotations trim partial MCUs
+        self.data = skimage.data.astronaut()[:203, :157]
+
+    def test_transforms(self):
+        """Test that each transform decodes to the transformed image"""
+        for subsampling, (mcu_h, mcu_w) in [('4:4:4', (8, 8)),
+                                            ('4:2:2', (8, 16)),
+                                            ('4:2:0', (16, 16))]:
+            jpeg = JpegCompressor(subsampling=subsampling)
+            compressed = jpeg.compress(self.data)
+            full = jpeg.decompress(compressed)
+            trimmed_h = 203 - 203 % mcu_h
+            trimmed_w = 157 - 157 % mcu_w
+
+            expected = [
+                (flip_horizontal, full[:, trimmed_w - 1::-1]),
+                (flip_vertical, full[trimmed_h - 1::-1]),
+                (transpose, full.transpose(1, 0, 2)),
+                (lambda c: rotate(c, 90), np.rot90(full[:trimmed_h], -1)),
+                (lambda c: rotate(c, 180),
+                 np.rot90(full[:trimmed_h, :trimmed_w], 2)),
+                (lambda c: rotate(c, 270), np.rot90(full[:, :trimmed_w])),
+            ]
+            for function, image in expected:
+                transformed = function(compressed)
+                self.assertEqual((transformed.height, transformed.width),
+                                 image.shape[:2])
+                assert_array_equal(jpeg.decompress(transformed), image)
+
+    def test_lossless(self):
+        """Test that undoing a transform restores the coefficients"""
+        compressed = JpegCompressor(subsampling='4:2:2').compress(
+            self.data[:128, :96])
+        for function, inverse in [(flip_horizontal, flip_horizontal),
+                                  (transpose, transpose),
+                                  (lambda c: rotate(c, 90),
+                                   lambda c: rotate(c, 270))]:
+            restored = inverse(function(compressed))
+            self.assertEqual(restored.sampling, compressed.sampling)
+            for coeffs, expected in zip(restored.coefficients,
+                                        compressed.coefficients):
+                assert_array_equal(coeffs, expected)
+
+    def test_standard_decoder(self):
+        """Test that transposed tables and sampling are written to files"""
+        jpeg = JpegCompressor(gamma=1.0, subsampling='4:2:2')
+        compressed = rotate(jpeg.compress(self.data), 90)
+        stream = io.BytesIO()
+        jpeg.write(compressed, stream)
+
+        stream.seek(0)
+        decoded = np.asarray(Image.open(stream).convert('RGB'))
+        expected = jpeg.decompress(compressed).astype(float)
+        self.assertEqual(decoded.shape, expected.shape)
+        self.assertLess(np.sqrt(np.mean((decoded - expected)**2)), 8)
+
+    def test_crop(self):
+        jpeg = JpegCompressor(subsampling='4:2:0')
+        compressed = jpeg.compress(self.data)
+        full = jpeg.decompress(compressed)
+
+        cropped = crop(compressed, 16, 32, 100, 300)
+        self.assertEqual((cropped.height, cropped.width), (100, 125))
+        assert_array_equal(jpeg.decompress(cropped), full[16:116, 32:])
+
+        with self.assertRaises(ValueError):
+            crop(compressed, 8, 0, 16, 16)
+        with self.assertRaises(ValueError):
+            crop(compressed, 208, 0, 16, 16)
+        with self.assertRaises(ValueError):
+            rotate(compressed, 45)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
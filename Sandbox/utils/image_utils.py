@@ -1,31 +1,126 @@
 # -*- coding: utf-8 -*-
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def pad_image(image, multiple, pad_mode='edge'):
+    """Pad the bottom and right of the last two axes of image up to a
+    multiple of the (rows, cols) in multiple
+
+    The image is returned unchanged, without copying, if no padding is
+    needed."""
+    image = np.asarray(image)
+    height, width = image.shape[-2:]
+
+    pad_h = -height % multiple[0]
+    pad_w = -width % multiple[1]
+    if pad_h or pad_w:
+        pad_width = [(0, 0)] * (image.ndim - 2) + [(0, pad_h), (0, pad_w)]
+        image = np.pad(image, pad_width, mode=pad_mode)
+
+    return image
+
+
+def block_view(image, block_shape=(8, 8), pad_mode='edge'):
+    """Return a strided (..., rows, cols, bh, bw) view of the image blocks
+
+    The last two axes of image are tiled into blocks of block_shape.  No data
+    is copied unless a dimension is not a multiple of the block size, in which
+    case the image is first padded with np.pad using pad_mode ('edge'
+    replicates the last row and column)."""
+    image = pad_image(image, block_shape, pad_mode)
+    bh, bw = block_shape
+
+    rows = image.shape[-2] // bh
+    cols = image.shape[-1] // bw
+    stride_h, stride_w = image.strides[-2:]
+
+    shape = image.shape[:-2] + (rows, cols, bh, bw)
+    strides = image.strides[:-2] + (stride_h * bh, stride_w * bw,
+                                    stride_h, stride_w)
+
+    return as_strided(image, shape=shape, strides=strides)
 
 
 def split_image(image, split_shape=(8, 8)):
-    """Return a list of 8x8 image blocks to be used for further jpeg
-    compression steps"""
+    """Return a list of 8x8 (or split_shape) image blocks to be used for
+    further jpeg compression steps
 
-    # TODO: Replace with skimage.view_as_blocks?
-    image_blocks_axis0 = np.split(image, range(8, image.shape[0], 8))
-    image_blocks_lists = [np.split(block, range(8, image.shape[1], 8),
-                                   axis=1) for block in image_blocks_axis0]
+    Blocks are views into image.  Blocks on the bottom and right edges are
+    truncated when the image is not evenly divisible by split_shape."""
+    bh, bw = split_shape
+    return [image[row:row + bh, col:col + bw]
+            for row in range(0, image.shape[0], bh)
+            for col in range(0, image.shape[1], bw)]
 
-    return sum(image_blocks_lists, [])
 
+def unsplit_image(blocks, shape=None, out=None):
+    """Reassemble image blocks into a single image.
 
-def unsplit_image(block_list, shape):
-    """Take a list of image blocks and a shape tuple that defines the block
-    arrangement and return the reconstructed image.
+    blocks is either a list of blocks in row-major order, with shape giving
+    the (rows, cols) block arrangement, or an array of blocks shaped
+    (..., rows, cols, bh, bw).  An array of shape (..., n_blocks, bh, bw) is
+    also accepted when shape is given.  In the list form the blocks on the
+    bottom and right edges may be smaller than the others.
 
-    Assumes all blocks are the same shape"""
-    block_start = 0
-    for n in range(shape[0]):
-        image_row = np.hstack(block_list[block_start:block_start+shape[0]])
-        if 'image' in locals():
-            image = np.vstack((image, image_row))
-        else:
-            image = image_row
-        block_start += shape[0]
+    The blocks are written into a single preallocated image, or into out if
+    it is supplied."""
+    if isinstance(blocks, np.ndarray):
+        if shape is not None:
+            blocks = blocks.reshape(blocks.shape[:-3] + tuple(shape) +
+                                    blocks.shape[-2:])
+        rows, cols, bh, bw = blocks.shape[-4:]
+        image_shape = blocks.shape[:-4] + (rows * bh, cols * bw)
 
-    return image
+        if out is None:
+            out = np.empty(image_shape, dtype=blocks.dtype)
+        elif out.shape != image_shape:
+            raise ValueError("out has shape {}, expected {}".format(
+                out.shape, image_shape))
+
+        block_view(out, (bh, bw))[...] = blocks
+        return out
+
+    rows, cols = shape
+    if len(blocks) != rows * cols:
+        raise ValueError("Expected {} blocks, got {}".format(rows * cols,
+                                                             len(blocks)))
+
+    # Edge blocks may be truncated, so size each row and column separately
+    row_edges = np.cumsum([0] + [blocks[row * cols].shape[0]
+                                 for row in range(rows)])
+    col_edges = np.cumsum([0] + [block.shape[1] for block in blocks[:cols]])
+    image_shape = (row_edges[-1], col_edges[-1])
+
+    if out is None:
+        out = np.empty(image_shape, dtype=blocks[0].dtype)
+    elif out.shape != image_shape:
+        raise ValueError("out has shape {}, expected {}".format(out.shape,
+                                                                image_shape))
+
+    for n, block in enumerate(blocks):
+        row, col = divmod(n, cols)
+        out[row_edges[row]:row_edges[row + 1],
+            col_edges[col]:col_edges[col + 1]] = block
+
+    return out
+
+
+def downsample(image, factors, dtype=None):
+    """Box filter the last two axes of image down by (row, col) factors
+
+    Each output pixel is the mean of a factors-shaped block of input pixels,
+    computed in dtype (float64 by default for integer images).  Partial
+    blocks at the edges are edge padded first."""
+    if tuple(factors) == (1, 1):
+        return np.asarray(image)
+    return block_view(image, factors).mean(axis=(-2, -1), dtype=dtype)
+
+
+def upsample(image, factors):
+    """Replicate each pixel of the last two axes of image into a
+    factors-shaped block, inverting downsample"""
+    if tuple(factors) == (1, 1):
+        return np.asarray(image)
+    image = np.repeat(image, factors[0], axis=-2)
+    return np.repeat(image, factors[1], axis=-1)
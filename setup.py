@@ -7,5 +7,6 @@ setup(name='TestProject',
       description='My Python Sandbox',
       author='Jonathan Hilliard',
       author_email='jfhilliard@gmail.com',
-      packages=find_packages()
+      packages=find_packages(),
+      python_requires='>=3.6'
       )